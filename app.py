@@ -1,10 +1,30 @@
 import os
 import sqlite3
 import pandas as pd
+import numpy as np
 import io
+import openpyxl
 import re
-from datetime import datetime
-from flask import Flask, render_template, jsonify, request, redirect, url_for, send_from_directory, send_file, flash
+import json
+import threading
+import tempfile
+import shutil
+import time
+import zipfile
+import uuid
+import hashlib
+import zlib
+import pathlib
+import xlsxwriter
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import cProfile
+import contextlib
+import contextvars
+from datetime import datetime, timedelta
+from flask import Flask, render_template, jsonify, request, redirect, url_for, send_from_directory, flash, abort, g, Response
 from werkzeug.utils import secure_filename
 from rapidfuzz import process, fuzz
 import traceback
@@ -14,15 +34,46 @@ app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-DATABASE_PATH = os.path.join(BASE_DIR, 'sistema.db')
+UPLOAD_FOLDER = os.environ.get('VALIDADOR_UPLOAD_FOLDER', os.path.join(BASE_DIR, 'uploads'))
+OUTPUT_FOLDER = os.environ.get('VALIDADOR_OUTPUT_FOLDER', os.path.join(BASE_DIR, 'outputs'))
+DATABASE_PATH = os.environ.get('VALIDADOR_DATABASE', os.path.join(BASE_DIR, 'sistema.db'))
+PROFILES_FOLDER = os.path.join(OUTPUT_FOLDER, 'profiles')
+RELATORIOS_SOD_FOLDER = os.path.join(OUTPUT_FOLDER, 'relatorios_sod')
 
 app.config.update(
     UPLOAD_FOLDER=UPLOAD_FOLDER,
-    DATABASE=DATABASE_PATH
+    OUTPUT_FOLDER=OUTPUT_FOLDER,
+    DATABASE=DATABASE_PATH,
+    PROFILES_FOLDER=PROFILES_FOLDER,
+    RELATORIOS_SOD_FOLDER=RELATORIOS_SOD_FOLDER,
+    # Com PERFILAR_REQUISICOES=1, ?perfil=1 (ou X-Perfil: 1) grava um .prof do cProfile.
+    PERFILAR_REQUISICOES=os.environ.get('PERFILAR_REQUISICOES') == '1'
 )
 
+SOD_LOTE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+TAREFAS_WORKERS = 2
+TAREFAS_RETENCAO_DIAS = 7
+TAREFAS_SINAL_SEGUNDOS = 15  # intervalo em que o processo dono renova atualizado_em das suas tarefas
+TAREFAS_SEM_SINAL_SEGUNDOS = 120  # sem renovação por esse tempo, a tarefa é dada como perdida
+RELATORIOS_SOD_RETENCAO_DIAS = 1
+MAX_ARQUIVOS_ZIP = 500  # planilhas por lote, somando todos os .zip enviados
+MAX_BYTES_ZIP_DESCOMPACTADO = 512 * 1024 * 1024  # tamanho descompactado declarado dos membros aceitos
+CACHE_RESULTADOS_MAX_BYTES = 256 * 1024 * 1024
 LIMIAR_ALERTA = 0.90 
+TOP_N_SUGESTOES_PADRAO = 3
+SCORE_MINIMO_PADRAO = 80
+MAX_CELULAS_CDIST = 4_000_000  # limita a matriz (usuário x VAR) calculada por bloco no cdist
+FOLGA_ESCOPO = 5.0  # pontos de score em que um nó do ramo do código ainda passa à frente do melhor do módulo
+LIMIAR_PREFILTRO_FTS = 20_000  # módulos maiores que isso usam o índice FTS5 para escolher candidatos ao fuzzy
+CANDIDATOS_FTS = 200
+MODULO_AUTOMATICO = '__auto__'  # valor de `modulo` em /comparar que pede a detecção do módulo
+AMOSTRA_DETECCAO_MODULO = 200  # linhas sem match exato pontuadas contra todos os módulos na detecção
+ANALISES_RETENCAO_DIAS = 7
+TAMANHO_PAGINA_ANALISE = 500  # linhas devolvidas junto com o resumo de /comparar
+TAMANHO_PAGINA_MAXIMO = 5000
+LINHAS_POR_BLOCO_IMPORTACAO = 20_000
+HISTORICO_POR_PAGINA = 20
+VAR_TABELAS_MANTIDAS = 5  # uploads não ativos (os mais recentes) que mantêm a tabela var_<id> pronta para reativar
 MODULOS_PADRAO = [
     'TOTVS Educacional', 'TOTVS Folha de Pagamento', 'TOTVS Gestão Contábil',
     'TOTVS Gestão de Estoque, Compras e Faturamento', 'TOTVS Gestão de Pessoas',
@@ -31,53 +82,912 @@ MODULOS_PADRAO = [
 ]
 
 # --- Funções Auxiliares e Setup ---
-def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
+PRAGMAS_SQLITE = {
+    'synchronous': 'NORMAL',  # seguro em WAL; o fsync fica para os checkpoints
+    'busy_timeout': 10_000,  # ms esperando o lock de escrita de outro worker antes de falhar
+    'cache_size': -64_000,  # KiB por conexão
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
+}
+_conexoes = threading.local()
+
+def _abrir_conexao(somente_leitura):
+    caminho = os.path.abspath(app.config['DATABASE'])
+    if somente_leitura:
+        conn = sqlite3.connect(f"{pathlib.Path(caminho).as_uri()}?mode=ro", uri=True)
+    else:
+        conn = sqlite3.connect(caminho)
     conn.row_factory = sqlite3.Row
+    for pragma, valor in PRAGMAS_SQLITE.items():
+        conn.execute(f'PRAGMA {pragma} = {valor}')
     return conn
 
+def get_db_connection(somente_leitura=False):
+    # Uma por (pid, thread): é reutilizada e não deve ser fechada.
+    abertas = getattr(_conexoes, 'abertas', None)
+    if abertas is None:
+        abertas = _conexoes.abertas = {}
+    chave = (os.getpid(), app.config['DATABASE'], somente_leitura)
+    conn = abertas.get(chave)
+    if conn is None:
+        conn = abertas[chave] = _abrir_conexao(somente_leitura)
+    return conn
+
+def liberar_conexoes():
+    for (pid, _, _), conn in getattr(_conexoes, 'abertas', {}).items():
+        if pid == os.getpid() and conn.in_transaction:
+            conn.rollback()
+
+@app.teardown_request
+def liberar_conexoes_requisicao(exc):
+    liberar_conexoes()
+
+@contextlib.contextmanager
+def transacao(conn):
+    # BEGIN IMMEDIATE: o DDL entra na transação e o lock de escrita vem antes de qualquer leitura.
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
 def init_db():
     conn = get_db_connection()
+    conn.execute('PRAGMA journal_mode = WAL')
     conn.execute('''
         CREATE TABLE IF NOT EXISTS uploads_historico (
             id INTEGER PRIMARY KEY AUTOINCREMENT, nome_arquivo_original TEXT NOT NULL,
             nome_arquivo_salvo TEXT NOT NULL, timestamp DATETIME NOT NULL, status TEXT NOT NULL 
         )
     ''')
-    conn.execute('CREATE TABLE IF NOT EXISTS dados_var ("ID Funcionalidade" TEXT, "Funcionalidade" TEXT, "ID Módulo" TEXT, "Módulo" TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_historico_timestamp ON uploads_historico (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_historico_status ON uploads_historico (status)')
+    migrar_dados_var(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS matrizes_risco_historico (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, nome_arquivo_original TEXT NOT NULL,
+            timestamp DATETIME NOT NULL, status TEXT NOT NULL, total_riscos INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS riscos_sod (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, matriz_id INTEGER NOT NULL,
+            "ID Risco" TEXT, "Descrição Risco" TEXT, "Criticidade" TEXT, "Aprovador" TEXT, "Sistema" TEXT,
+            "Módulo" TEXT, "Atividade" TEXT, "Funcionalidade" TEXT, "Atividade2" TEXT, "Funcionalidade 2" TEXT
+        )
+    ''')
+    # Índice invertido funcionalidade -> risco: cada par conflitante entra uma vez por lado.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS riscos_sod_funcionalidade (
+            matriz_id INTEGER NOT NULL, funcionalidade TEXT NOT NULL, risco_id INTEGER NOT NULL, conflitante TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_riscos_sod_funcionalidade ON riscos_sod_funcionalidade (matriz_id, funcionalidade)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_resultados (
+            chave TEXT PRIMARY KEY, tipo TEXT NOT NULL, versao_var INTEGER, tamanho INTEGER NOT NULL,
+            resultado BLOB NOT NULL, criado_em DATETIME NOT NULL, acessado_em DATETIME NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_resultados_acesso ON cache_resultados (acessado_em)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS analises (
+            id TEXT PRIMARY KEY, modulo TEXT, versao_var INTEGER, total INTEGER NOT NULL,
+            resumo TEXT NOT NULL, criado_em DATETIME NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS analises_resultados (
+            analise_id TEXT NOT NULL, posicao INTEGER NOT NULL, status TEXT NOT NULL, dados TEXT NOT NULL,
+            PRIMARY KEY (analise_id, posicao)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analises_resultados_status ON analises_resultados (analise_id, status, posicao)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tarefas (
+            id TEXT PRIMARY KEY, tipo TEXT NOT NULL, status TEXT NOT NULL, etapa TEXT,
+            progresso INTEGER, total INTEGER, resultado TEXT, erro TEXT,
+            criado_em DATETIME NOT NULL, atualizado_em DATETIME NOT NULL, pid INTEGER
+        )
+    ''')
+    with transacao(conn):
+        if 'pid' not in {row['name'] for row in conn.execute('PRAGMA table_info(tarefas)')}:
+            conn.execute('ALTER TABLE tarefas ADD COLUMN pid INTEGER')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metricas (
+            nome TEXT NOT NULL, rotulos TEXT NOT NULL, valor REAL NOT NULL,
+            PRIMARY KEY (nome, rotulos)
+        ) WITHOUT ROWID
+    ''')
     conn.commit()
-    conn.close()
 
 def setup():
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['RELATORIOS_SOD_FOLDER'], exist_ok=True)
     init_db()
 
-setup()
-
 def allowed_file(filename, allowed_extensions={'xlsx', 'xls'}):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-# --- LÓGICA DO ANALISADOR DE RISCOS SoD (Atualizada) ---
+def normalizar_funcionalidade(valor):
+    return str(valor).lower().strip()
+
+# --- TABELAS DA VAR ---
+# dados_var é uma VIEW sobre var_<id> da versão ativa: ativar só recria a view.
+MAPA_COLUNAS_VAR = {"id": "ID Funcionalidade", "funcionalidade": "Funcionalidade", "modulo id": "ID Módulo", "modulo": "Módulo"}
+COLUNAS_VAR = list(MAPA_COLUNAS_VAR.values())
+_fts_disponivel = True
+
+def tabela_var(upload_id):
+    return f'var_{int(upload_id)}'
+
+def tabela_var_existe(conn, upload_id):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela_var(upload_id),)).fetchone() is not None
+
+def criar_tabela_var(conn, upload_id, df_var):
+    # Nomes iguais após normalizar, no mesmo módulo, ficam só com a primeira linha.
+    global _fts_disponivel
+    tabela = tabela_var(upload_id)
+    df_var = df_var[COLUNAS_VAR].astype(object)
+    df_var = df_var.where(df_var.notna(), None)
+    linhas = [(*valores, normalizar_funcionalidade(valores[1])) for valores in df_var.itertuples(index=False, name=None)]
+    with transacao(conn):
+        conn.execute(f'DROP TABLE IF EXISTS {tabela}_fts')
+        conn.execute(f'DROP TABLE IF EXISTS {tabela}')
+        conn.execute(f'''
+            CREATE TABLE {tabela} (
+                id INTEGER PRIMARY KEY, "ID Funcionalidade" TEXT, "Funcionalidade" TEXT, "ID Módulo" TEXT, "Módulo" TEXT,
+                "Funcionalidade_norm" TEXT NOT NULL
+            )
+        ''')
+        conn.execute(f'CREATE INDEX idx_{tabela}_modulo ON {tabela} ("Módulo")')
+        conn.execute(f'CREATE UNIQUE INDEX idx_{tabela}_modulo_norm ON {tabela} ("Módulo", "Funcionalidade_norm")')
+        conn.execute(f'CREATE INDEX idx_{tabela}_norm ON {tabela} ("Funcionalidade_norm")')
+        conn.executemany(f'INSERT OR IGNORE INTO {tabela} ("ID Funcionalidade", "Funcionalidade", "ID Módulo", "Módulo", "Funcionalidade_norm") VALUES (?, ?, ?, ?, ?)', linhas)
+
+        if _fts_disponivel:
+            try:
+                conn.execute(f"CREATE VIRTUAL TABLE {tabela}_fts USING fts5(\"Funcionalidade_norm\", content='{tabela}', content_rowid='id', tokenize='trigram')")
+                conn.execute(f"INSERT INTO {tabela}_fts ({tabela}_fts) VALUES ('rebuild')")
+            except sqlite3.OperationalError:
+                app.logger.warning('SQLite sem suporte a FTS5 trigram; a busca fuzzy vai usar o módulo inteiro.')
+                _fts_disponivel = False
+    return len(linhas)
+
+def limpar_tabelas_var(conn):
+    mantidos = {row['id'] for row in conn.execute('SELECT id FROM uploads_historico WHERE status = "Ativo"')}
+    mantidos.update(row['id'] for row in conn.execute(
+        'SELECT id FROM uploads_historico WHERE status IN ("Válido", "Arquivado") ORDER BY id DESC LIMIT ?', (VAR_TABELAS_MANTIDAS,)))
+    for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'var_[0-9]*'").fetchall():
+        tabela = row['name']
+        # var_<id>_fts e as tabelas internas do FTS5 caem junto com a tabela principal.
+        if tabela[len('var_'):].isdigit() and int(tabela[len('var_'):]) not in mantidos:
+            conn.execute(f'DROP TABLE IF EXISTS {tabela}_fts')
+            conn.execute(f'DROP TABLE IF EXISTS {tabela}')
+
+def apontar_dados_var(conn, upload_id):
+    conn.execute('DROP VIEW IF EXISTS dados_var')
+    conn.execute(f'CREATE VIEW dados_var AS SELECT * FROM {tabela_var(upload_id)}')
+
+def var_ativa_disponivel(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'dados_var'").fetchone() is not None and conn.execute('SELECT 1 FROM dados_var').fetchone() is not None
+
+def listar_historico_var(conn, pagina=1, tamanho_pagina=HISTORICO_POR_PAGINA):
+    total = conn.execute('SELECT COUNT(*) FROM uploads_historico').fetchone()[0]
+    rows = conn.execute('''
+        SELECT id, nome_arquivo_original, status, COALESCE(strftime('%d/%m/%Y às %H:%M', timestamp), '') AS timestamp_formatado
+        FROM uploads_historico ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+    ''', (tamanho_pagina, (pagina - 1) * tamanho_pagina)).fetchall()
+    return {'total': total, 'pagina': pagina, 'tamanho_pagina': tamanho_pagina, 'total_paginas': -(-total // tamanho_pagina),
+            'itens': [dict(row) for row in rows]}
+
+def dados_var_legado(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dados_var'").fetchone() is not None
+
+def migrar_dados_var(conn):
+    if not dados_var_legado(conn):
+        return
+    with transacao(conn):
+        # Outro worker pode ter migrado enquanto esperávamos o lock.
+        if not dados_var_legado(conn):
+            return
+        ativo = conn.execute('SELECT id FROM uploads_historico WHERE status = "Ativo" ORDER BY id DESC LIMIT 1').fetchone()
+        if ativo:
+            df_legado = pd.read_sql_query('SELECT * FROM dados_var', conn)
+            criar_tabela_var(conn, ativo['id'], df_legado.reindex(columns=COLUNAS_VAR))
+        conn.execute('DROP TABLE IF EXISTS dados_var_fts')
+        conn.execute('DROP TABLE dados_var')
+        if ativo:
+            apontar_dados_var(conn, ativo['id'])
+
+def buscar_exatos_var(conn, versao_var, modulo, funcionalidades_norm):
+    rows = conn.execute(f'''
+        SELECT d."Funcionalidade_norm", d."ID Funcionalidade", d."Funcionalidade" FROM {tabela_var(versao_var)} d
+        WHERE d."Módulo" = ? AND d."Funcionalidade_norm" IN (SELECT value FROM json_each(?))
+    ''', (modulo, json.dumps(list(set(funcionalidades_norm)), ensure_ascii=False))).fetchall()
+    return {row['Funcionalidade_norm']: row for row in rows}
+
+def buscar_candidatos_fts(conn, versao_var, modulo, consulta, limite=CANDIDATOS_FTS):
+    termos = {palavra for palavra in re.split(r'\s+', consulta) if len(palavra) >= 3}
+    if not _fts_disponivel or not termos:
+        return []
+    tabela = tabela_var(versao_var)
+    expressao = ' OR '.join('"' + termo.replace('"', '""') + '"' for termo in termos)
+    rows = conn.execute(f'''
+        SELECT d.id FROM {tabela}_fts f JOIN {tabela} d ON d.id = f.rowid
+        WHERE {tabela}_fts MATCH ? AND d."Módulo" = ? ORDER BY f.rank LIMIT ?
+    ''', (expressao, modulo, limite)).fetchall()
+    return [row['id'] for row in rows]
+
+# Os workers do pool SoD importam o módulo; o processo principal já preparou banco e pastas.
+if multiprocessing.parent_process() is None:
+    setup()
+
+# --- INSTRUMENTAÇÃO ---
+# Totais somados em memória e descarregados na tabela `metricas`: /metrics soma todos os processos.
+METRICAS_DESCARGA_SEGUNDOS = 10
+_etapas_requisicao = contextvars.ContextVar('etapas_requisicao', default=None)
+_metricas_lock = threading.Lock()
+_metricas = {'etapas': {}, 'contadores': {}, 'pid': os.getpid(), 'ultima_descarga': time.monotonic()}
+
+DESCRICAO_CONTADORES = {
+    'validador_linhas_processadas_total': 'Linhas de planilha processadas, por operação.',
+    'validador_fuzzy_chamadas_total': 'Chamadas ao process.cdist do rapidfuzz.',
+    'validador_fuzzy_comparacoes_total': 'Pares (consulta x VAR) pontuados pelo rapidfuzz.',
+    'validador_cache_total': 'Consultas aos caches, por tipo e resultado (hit/miss).',
+}
+
+@contextlib.contextmanager
+def medir(etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        etapas = _etapas_requisicao.get()
+        if etapas is not None:
+            etapas.append((etapa, duracao))
+        with _metricas_lock:
+            total = _metricas['etapas'].setdefault(etapa, [0, 0.0])
+            total[0] += 1
+            total[1] += duracao
+
+def contar(nome, quantidade=1, **rotulos):
+    chave = (nome, tuple(sorted(rotulos.items())))
+    with _metricas_lock:
+        _metricas['contadores'][chave] = _metricas['contadores'].get(chave, 0) + quantidade
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(nome, str(valor).replace('\\', '\\\\').replace('"', '\\"')) for nome, valor in rotulos) + '}'
+
+def descarregar_metricas():
+    with _metricas_lock:
+        if _metricas['pid'] != os.getpid():
+            # Processo filho de um fork: o acumulado herdado é do pai, que o descarrega.
+            _metricas.update(etapas={}, contadores={}, pid=os.getpid())
+        etapas, contadores = _metricas['etapas'], _metricas['contadores']
+        _metricas.update(etapas={}, contadores={}, ultima_descarga=time.monotonic())
+    linhas = [('validador_etapa_segundos_count', [['etapa', etapa]], quantidade) for etapa, (quantidade, _) in etapas.items()]
+    linhas += [('validador_etapa_segundos_sum', [['etapa', etapa]], soma) for etapa, (_, soma) in etapas.items()]
+    linhas += [(nome, [list(rotulo) for rotulo in rotulos], valor) for (nome, rotulos), valor in contadores.items()]
+    if not linhas:
+        return
+    try:
+        conn = get_db_connection()
+        with conn:
+            conn.executemany('INSERT INTO metricas (nome, rotulos, valor) VALUES (?, ?, ?) ON CONFLICT (nome, rotulos) DO UPDATE SET valor = valor + excluded.valor',
+                             [(nome, json.dumps(rotulos, ensure_ascii=False), valor) for nome, rotulos, valor in linhas])
+    except sqlite3.Error:
+        app.logger.warning("Não foi possível gravar as métricas; ficam para a próxima descarga", exc_info=True)
+        with _metricas_lock:
+            for etapa, (quantidade, soma) in etapas.items():
+                total = _metricas['etapas'].setdefault(etapa, [0, 0.0])
+                total[0] += quantidade
+                total[1] += soma
+            for chave, valor in contadores.items():
+                _metricas['contadores'][chave] = _metricas['contadores'].get(chave, 0) + valor
+
+def exportar_metricas():
+    descarregar_metricas()
+    etapas, contadores = {}, {}
+    for row in get_db_connection(somente_leitura=True).execute('SELECT nome, rotulos, valor FROM metricas'):
+        rotulos = tuple(tuple(rotulo) for rotulo in json.loads(row['rotulos']))
+        valor = int(row['valor']) if float(row['valor']).is_integer() else row['valor']
+        if row['nome'] in ('validador_etapa_segundos_count', 'validador_etapa_segundos_sum'):
+            etapas.setdefault(rotulos[0][1], [0, 0.0])[row['nome'].endswith('_sum')] = valor
+        else:
+            contadores[(row['nome'], rotulos)] = valor
+    linhas = [
+        '# HELP validador_etapa_segundos Tempo gasto em cada etapa instrumentada.',
+        '# TYPE validador_etapa_segundos summary',
+    ]
+    for etapa, (quantidade, soma) in sorted(etapas.items()):
+        linhas.append(f'validador_etapa_segundos_count{{etapa="{etapa}"}} {quantidade}')
+        linhas.append(f'validador_etapa_segundos_sum{{etapa="{etapa}"}} {soma:.6f}')
+    for nome in sorted({nome for nome, _ in contadores}):
+        linhas.append(f'# HELP {nome} {DESCRICAO_CONTADORES.get(nome, nome)}')
+        linhas.append(f'# TYPE {nome} counter')
+        for (nome_contador, rotulos), valor in sorted(contadores.items()):
+            if nome_contador == nome:
+                linhas.append(f'{nome}{_rotulos_prometheus(rotulos)} {valor}')
+    return '\n'.join(linhas) + '\n'
+
+@app.before_request
+def iniciar_medicao():
+    g.inicio_requisicao = time.perf_counter()
+    g.token_etapas = _etapas_requisicao.set([])
+    g.perfil = None
+    if app.config['PERFILAR_REQUISICOES'] and '1' in (request.args.get('perfil'), request.headers.get('X-Perfil')):
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+@app.after_request
+def registrar_medicao(response):
+    if g.get('perfil') is not None:
+        g.perfil.disable()
+        os.makedirs(app.config['PROFILES_FOLDER'], exist_ok=True)
+        nome_perfil = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{request.endpoint or 'desconhecido'}_{uuid.uuid4().hex[:8]}.prof"
+        g.perfil.dump_stats(os.path.join(app.config['PROFILES_FOLDER'], nome_perfil))
+        g.perfil = None
+    etapas = _etapas_requisicao.get()
+    if etapas is not None and 'inicio_requisicao' in g:
+        total = time.perf_counter() - g.inicio_requisicao
+        with _metricas_lock:
+            # Sem endpoint (404, 405): um rótulo só, em vez de requisicao_None.
+            acumulado = _metricas['etapas'].setdefault(f"requisicao_{request.endpoint or 'nao_encontrado'}", [0, 0.0])
+            acumulado[0] += 1
+            acumulado[1] += total
+            descarregar = time.monotonic() - _metricas['ultima_descarga'] >= METRICAS_DESCARGA_SEGUNDOS
+        if descarregar and not get_db_connection().in_transaction:
+            descarregar_metricas()
+        response.headers['Server-Timing'] = ', '.join([f'{etapa};dur={duracao * 1000:.1f}' for etapa, duracao in etapas] + [f'total;dur={total * 1000:.1f}'])
+    return response
+
+@app.teardown_request
+def encerrar_medicao(exc):
+    token = g.pop('token_etapas', None)
+    if token is not None:
+        _etapas_requisicao.reset(token)
+
+@app.route('/metrics')
+def metrics():
+    return Response(exportar_metricas(), mimetype='text/plain; version=0.0.4')
+
+# --- CACHE DO CATÁLOGO VAR ---
+# Por processo; a versão (id do upload Ativo) é conferida a cada uso.
+_catalogo_lock = threading.Lock()
+_catalogo_estado = {'versao': None, 'modulos': None, 'por_modulo': {}}
+
+def obter_versao_var(conn):
+    row = conn.execute('SELECT id FROM uploads_historico WHERE status = "Ativo" ORDER BY id DESC LIMIT 1').fetchone()
+    return row['id'] if row else None
+
+def _montar_catalogo_modulo(df_modulo):
+    nomes_originais = df_modulo['Funcionalidade'].tolist()
+    lista_norm = df_modulo['Funcionalidade_norm'].tolist()
+    ids = df_modulo['ID Funcionalidade'].tolist()
+    return {
+        'lista_norm': lista_norm, 'ids': ids, 'nomes_originais': nomes_originais,
+        'posicao_por_rowid': {rowid: posicao for posicao, rowid in enumerate(df_modulo['id'].tolist())},
+        'indice': montar_indice_hierarquico(lista_norm, nomes_originais),
+    }
 
-def encontrar_linha_titulo(df_bruto, padrao_titulo):
-    for index, row in df_bruto.iterrows():
-        cell_value = str(row.iloc[0])
-        if padrao_titulo in cell_value:
-            return index
+COLUNAS_CATALOGO_VAR = 'id, "ID Funcionalidade", "Funcionalidade", "Módulo", "Funcionalidade_norm"'
+
+def ler_dados_var(conn, versao_var, modulo):
+    return pd.read_sql_query(f'SELECT {COLUNAS_CATALOGO_VAR} FROM {tabela_var(versao_var)} WHERE "Módulo" = ? ORDER BY id', conn, params=(modulo,))
+
+def ler_dados_var_completa(conn, versao_var):
+    return pd.read_sql_query(f'SELECT {COLUNAS_CATALOGO_VAR} FROM {tabela_var(versao_var)} ORDER BY id', conn)
+
+def trocar_cache_catalogo(versao, df_var=None):
+    global _catalogo_estado
+    novo_estado = {'versao': versao, 'modulos': None, 'por_modulo': {}}
+    if df_var is not None:
+        novo_estado['modulos'] = sorted(df_var['Módulo'].dropna().unique().tolist())
+        for modulo, df_modulo in df_var.groupby('Módulo', sort=False):
+            novo_estado['por_modulo'][modulo] = _montar_catalogo_modulo(df_modulo)
+    with _catalogo_lock:
+        _catalogo_estado = novo_estado
+    return novo_estado
+
+def _estado_catalogo_atual(conn):
+    versao = obter_versao_var(conn)
+    estado = _catalogo_estado
+    if estado['versao'] != versao:
+        estado = trocar_cache_catalogo(versao)
+    return estado
+
+def obter_catalogo_var(conn, modulo, versao=None):
+    estado = _estado_catalogo_atual(conn)
+    if versao is not None and versao != estado['versao']:
+        # VAR trocada no meio da requisição: monta a versão pedida sem guardar.
+        return _montar_catalogo_modulo(ler_dados_var(conn, versao, modulo))
+    catalogo = estado['por_modulo'].get(modulo)
+    contar('validador_cache_total', tipo='catalogo', resultado='miss' if catalogo is None else 'hit')
+    if catalogo is None:
+        catalogo = _montar_catalogo_modulo(ler_dados_var(conn, estado['versao'], modulo))
+        # Só guarda se a VAR não mudou durante a leitura.
+        if obter_versao_var(conn) == estado['versao']:
+            with _catalogo_lock:
+                estado['por_modulo'][modulo] = catalogo
+    return catalogo
+
+def obter_modulos_var(conn):
+    estado = _estado_catalogo_atual(conn)
+    modulos = estado['modulos']
+    if modulos is None:
+        modulos_df = pd.read_sql_query(f'SELECT DISTINCT "Módulo" FROM {tabela_var(estado["versao"])}', conn)
+        modulos = modulos_df["Módulo"].dropna().sort_values().tolist()
+        if obter_versao_var(conn) == estado['versao']:
+            estado['modulos'] = modulos
+    return modulos
+
+# --- DETECÇÃO AUTOMÁTICA DE MÓDULO ---
+def detectar_modulo(conn, versao_var, lista_func_usuario):
+    # fuzz.ratio em vez de WRatio: para escolher o módulo a diferença é pequena e o custo cai ~100x.
+    modulos = obter_modulos_var(conn)
+    rows = conn.execute(
+        f'SELECT "Módulo", "Funcionalidade_norm" FROM {tabela_var(versao_var)} WHERE "Funcionalidade_norm" IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(set(lista_func_usuario)), ensure_ascii=False),)).fetchall()
+    exatos = {}
+    for row in rows:
+        exatos[row['Módulo']] = exatos.get(row['Módulo'], 0) + 1
+    encontrados = {row['Funcionalidade_norm'] for row in rows}
+    sem_match = list(dict.fromkeys(func for func in lista_func_usuario if func not in encontrados))
+    passo = max(1, len(sem_match) // AMOSTRA_DETECCAO_MODULO)
+    amostra = sem_match[::passo][:AMOSTRA_DETECCAO_MODULO]
+
+    medias = dict.fromkeys(modulos, 0.0)
+    sugeridos = dict.fromkeys(modulos, 0.0)
+    if amostra:
+        colunas_por_bloco = max(1, MAX_CELULAS_CDIST // len(amostra))
+        melhores = np.zeros((len(amostra), len(modulos)), dtype=np.float32)
+        for indice, modulo in enumerate(modulos):
+            lista_norm = obter_catalogo_var(conn, modulo, versao_var)['lista_norm']
+            for inicio in range(0, len(lista_norm), colunas_por_bloco):
+                bloco = lista_norm[inicio:inicio + colunas_por_bloco]
+                matriz = process.cdist(amostra, bloco, scorer=fuzz.ratio, dtype=np.float32, workers=-1)
+                contar('validador_fuzzy_chamadas_total')
+                contar('validador_fuzzy_comparacoes_total', len(amostra) * len(bloco))
+                np.maximum(melhores[:, indice], matriz.max(axis=1), out=melhores[:, indice])
+        medias = {modulo: float(media) for modulo, media in zip(modulos, melhores.mean(axis=0))}
+        sugeridos = {modulo: float(fracao) * len(sem_match) for modulo, fracao in zip(modulos, (melhores >= SCORE_MINIMO_PADRAO).mean(axis=0))}
+
+    ranking = [
+        {
+            'Módulo': modulo, 'Encontrados': exatos.get(modulo, 0), 'Similaridade média (%)': round(medias[modulo], 2),
+            'Correspondências estimadas': round(exatos.get(modulo, 0) + sugeridos[modulo]),
+        }
+        for modulo in modulos
+    ]
+    ranking.sort(key=lambda item: (-item['Correspondências estimadas'], -item['Encontrados'], -item['Similaridade média (%)']))
+    return ranking
+
+# --- CACHE DE RESULTADOS ---
+def calcular_sha256(stream):
+    sha256 = hashlib.sha256()
+    for bloco in iter(lambda: stream.read(1024 * 1024), b''):
+        sha256.update(bloco)
+    stream.seek(0)
+    return sha256.hexdigest()
+
+def chave_cache(tipo, sha256_arquivo, **parametros):
+    return hashlib.sha256(json.dumps([tipo, sha256_arquivo, parametros], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def ler_cache_resultado(chave, tipo):
+    conn = get_db_connection()
+    row = conn.execute('SELECT resultado FROM cache_resultados WHERE chave = ?', (chave,)).fetchone()
+    contar('validador_cache_total', tipo=tipo, resultado='hit' if row else 'miss')
+    if not row:
+        return None
+    conn.execute('UPDATE cache_resultados SET acessado_em = ? WHERE chave = ?', (datetime.now(), chave))
+    conn.commit()
+    return json.loads(zlib.decompress(row['resultado']))
+
+def gravar_cache_resultado(chave, tipo, resultado, versao_var=None):
+    conteudo = zlib.compress(json.dumps(resultado, ensure_ascii=False, default=str).encode('utf-8'))
+    agora = datetime.now()
+    conn = get_db_connection()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO cache_resultados (chave, tipo, versao_var, tamanho, resultado, criado_em, acessado_em) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (chave, tipo, versao_var, len(conteudo), conteudo, agora, agora))
+        excedente = conn.execute('SELECT COALESCE(SUM(tamanho), 0) FROM cache_resultados').fetchone()[0] - CACHE_RESULTADOS_MAX_BYTES
+        if excedente > 0:
+            removidos = 0
+            chaves_removidas = []
+            for row in conn.execute('SELECT chave, tamanho FROM cache_resultados ORDER BY acessado_em'):
+                if removidos >= excedente:
+                    break
+                chaves_removidas.append((row['chave'],))
+                removidos += row['tamanho']
+            conn.executemany('DELETE FROM cache_resultados WHERE chave = ?', chaves_removidas)
+
+def invalidar_cache_var(conn, versao_var):
+    conn.execute('DELETE FROM cache_resultados WHERE tipo = "comparar" AND versao_var IS NOT ?', (versao_var,))
+
+# --- SESSÕES DE ANÁLISE ---
+COLUNAS_IMPORTACAO = ['id', 'perfil', 'funcionalidade id', 'funcionalidade']
+
+def salvar_analise(modulo, versao_var, resultados, resumo):
+    analise_id = uuid.uuid4().hex
+    agora = datetime.now()
+    conn = get_db_connection()
+    with conn:
+        expiradas = conn.execute('SELECT id FROM analises WHERE criado_em < ?', (agora - timedelta(days=ANALISES_RETENCAO_DIAS),)).fetchall()
+        conn.executemany('DELETE FROM analises_resultados WHERE analise_id = ?', [(row['id'],) for row in expiradas])
+        conn.executemany('DELETE FROM analises WHERE id = ?', [(row['id'],) for row in expiradas])
+        conn.execute('INSERT INTO analises (id, modulo, versao_var, total, resumo, criado_em) VALUES (?, ?, ?, ?, ?, ?)',
+                     (analise_id, modulo, versao_var, len(resultados), json.dumps(resumo, ensure_ascii=False, default=str), agora))
+        conn.executemany('INSERT INTO analises_resultados (analise_id, posicao, status, dados) VALUES (?, ?, ?, ?)',
+                         ((analise_id, posicao, item['Status'], json.dumps(item, ensure_ascii=False, default=str)) for posicao, item in enumerate(resultados)))
+    return analise_id
+
+def obter_analise(conn, analise_id):
+    return conn.execute('SELECT * FROM analises WHERE id = ?', (analise_id,)).fetchone()
+
+def _filtro_analise(analise_id, status=None):
+    if not status:
+        return 'analise_id = ?', [analise_id]
+    return f"analise_id = ? AND status IN ({', '.join('?' * len(status))})", [analise_id, *status]
+
+def ler_pagina_analise(conn, analise_id, pagina, tamanho_pagina, status=None):
+    filtro, parametros = _filtro_analise(analise_id, status)
+    total = conn.execute(f'SELECT COUNT(*) FROM analises_resultados WHERE {filtro}', parametros).fetchone()[0]
+    rows = conn.execute(f'SELECT dados FROM analises_resultados WHERE {filtro} ORDER BY posicao LIMIT ? OFFSET ?',
+                        [*parametros, tamanho_pagina, (pagina - 1) * tamanho_pagina]).fetchall()
+    return {'total': total, 'pagina': pagina, 'tamanho_pagina': tamanho_pagina, 'total_paginas': -(-total // tamanho_pagina),
+            'resultados': [json.loads(row['dados']) for row in rows]}
+
+def iterar_resultados_analise(analise_id, status=None):
+    filtro, parametros = _filtro_analise(analise_id, status)
+    for row in get_db_connection(somente_leitura=True).execute(f'SELECT dados FROM analises_resultados WHERE {filtro} ORDER BY posicao', parametros):
+        yield row['dados']
+
+def montar_resposta_analise(resumo, primeira_pagina, cache):
+    total = resumo['total']
+    return {**resumo, 'cache': cache, 'pagina': 1, 'tamanho_pagina': TAMANHO_PAGINA_ANALISE,
+            'total_paginas': -(-total // TAMANHO_PAGINA_ANALISE), 'resultados': primeira_pagina}
+
+def _coluna_texto(df, coluna):
+    if coluna not in df:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[coluna].fillna('').astype(str)
+
+def montar_colunas_importacao(df_analise, perfil_id, perfil_nome):
+    id_encontrado = _coluna_texto(df_analise, 'ID Encontrado').str.strip()
+    id_sugerido = _coluna_texto(df_analise, 'ID Sugerido').str.strip()
+    sugestao_var = _coluna_texto(df_analise, 'Sugestão Similar (VAR)').str.strip()
+    usa_sugestao = _coluna_texto(df_analise, 'Status').isin(['Encontrado', 'Divergente com Sugestão']) & (sugestao_var != '')
+    return pd.DataFrame({
+        'id': perfil_id,
+        'perfil': perfil_nome,
+        'funcionalidade id': np.where(id_encontrado != '', id_encontrado, np.where(id_sugerido != '', id_sugerido, '❗ Não encontrado')),
+        'funcionalidade': np.where(usa_sugestao, sugestao_var, _coluna_texto(df_analise, 'Funcionalidade Analisada')),
+    }, index=df_analise.index, columns=COLUNAS_IMPORTACAO)
+
+def ler_blocos_analise(analise_id):
+    yield from pd.read_sql_query('''
+        SELECT status AS "Status",
+               json_extract(dados, '$."Funcionalidade Analisada"') AS "Funcionalidade Analisada",
+               json_extract(dados, '$."ID Encontrado"') AS "ID Encontrado",
+               json_extract(dados, '$."ID Sugerido"') AS "ID Sugerido",
+               json_extract(dados, '$."Sugestão Similar (VAR)"') AS "Sugestão Similar (VAR)"
+        FROM analises_resultados WHERE analise_id = ? ORDER BY posicao
+    ''', get_db_connection(somente_leitura=True), params=(analise_id,), chunksize=LINHAS_POR_BLOCO_IMPORTACAO)
+
+def escrever_importacao_xlsx(blocos, caminho):
+    workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True, 'strings_to_formulas': False, 'strings_to_urls': False})
+    planilha = workbook.add_worksheet('Importa VAR')
+    planilha.write_row(0, 0, COLUNAS_IMPORTACAO, workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}))
+    linha = 1
+    for bloco in blocos:
+        for valores in bloco.itertuples(index=False, name=None):
+            planilha.write_row(linha, 0, valores)
+            linha += 1
+    workbook.close()
+
+def ler_em_blocos(caminho, tamanho_bloco=1024 * 1024):
+    with open(caminho, 'rb') as arquivo:
+        yield from iter(lambda: arquivo.read(tamanho_bloco), b'')
+
+def gerar_importacao_csv(blocos):
+    # BOM e ';' para o Excel em português.
+    yield '\ufeff' + ';'.join(COLUNAS_IMPORTACAO) + '\n'
+    for bloco in blocos:
+        yield bloco.to_csv(index=False, header=False, sep=';', lineterminator='\n')
+
+# --- ÍNDICE HIERÁRQUICO DA VAR ---
+# Trie achatada pelos códigos entre colchetes: cada prefixo aponta para as posições da sua subárvore.
+PADRAO_CODIGO_VAR = re.compile(r'^\s*\[(\d+(?:\.\d+)*)\]\s*')
+
+def extrair_codigo_var(nome):
+    match = PADRAO_CODIGO_VAR.match(str(nome))
+    return match.group(1) if match else None
+
+def montar_indice_hierarquico(lista_norm, nomes_originais):
+    posicao_por_codigo = {}
+    subarvores = {}
+    codigos = [extrair_codigo_var(nome) for nome in lista_norm]
+    for posicao, codigo in enumerate(codigos):
+        if codigo is None:
+            continue
+        posicao_por_codigo.setdefault(codigo, posicao)
+        partes = codigo.split('.')
+        for tamanho in range(1, len(partes) + 1):
+            subarvores.setdefault('.'.join(partes[:tamanho]), []).append(posicao)
+
+    caminhos = []
+    for posicao, codigo in enumerate(codigos):
+        if codigo is None:
+            caminhos.append(str(nomes_originais[posicao]))
+            continue
+        partes = codigo.split('.')
+        ancestrais = ['.'.join(partes[:tamanho]) for tamanho in range(1, len(partes) + 1)]
+        caminhos.append(' > '.join(PADRAO_CODIGO_VAR.sub('', str(nomes_originais[posicao_por_codigo[c]])) for c in ancestrais if c in posicao_por_codigo))
+
+    return {
+        'posicao_por_codigo': posicao_por_codigo,
+        'subarvores': {prefixo: np.array(posicoes) for prefixo, posicoes in subarvores.items()},
+        'caminhos': caminhos,
+        'nomes_sem_codigo': [PADRAO_CODIGO_VAR.sub('', nome) for nome in lista_norm],
+    }
+
+def escopo_do_codigo(codigo, indice):
+    partes = codigo.split('.')
+    for tamanho in range(len(partes) - 1, 0, -1):
+        prefixo = '.'.join(partes[:tamanho])
+        if prefixo in indice['subarvores']:
+            return prefixo
     return None
 
-def consolidar_colunas(df_bruto_slice, col_inicio, col_fim):
-    col_fim_real = min(col_fim, len(df_bruto_slice.columns))
-    return df_bruto_slice.iloc[:, col_inicio:col_fim_real].fillna('').astype(str).agg(''.join, axis=1)
+def definir_escopos(lista_func_usuario, encontrados, indice):
+    # Linha sem código herda o escopo do último item casado acima dela.
+    escopos = []
+    ultimo_codigo = None
+    for posicao, func_norm in enumerate(lista_func_usuario):
+        codigo = extrair_codigo_var(func_norm)
+        escopos.append(escopo_do_codigo(codigo, indice) if codigo else (escopo_do_codigo(ultimo_codigo, indice) if ultimo_codigo else None))
+        if codigo and (posicao in encontrados or codigo in indice['posicao_por_codigo']):
+            ultimo_codigo = codigo
+    return escopos
+
+def _sugerir_no_modulo(consultas, lista_busca, catalogo, top_n, score_minimo, buscar_candidatos=None):
+    if not buscar_candidatos or len(lista_busca) <= LIMIAR_PREFILTRO_FTS:
+        return sugerir_em_lote(consultas, lista_busca, top_n, score_minimo)
+    sugestoes = [[] for _ in consultas]
+    sem_candidatos = []
+    posicao_por_rowid = catalogo['posicao_por_rowid']
+    for posicao, consulta in enumerate(consultas):
+        # Na ordem da VAR, para manter o desempate do módulo inteiro.
+        posicoes_var = sorted(posicao_por_rowid[rowid] for rowid in buscar_candidatos(consulta) if rowid in posicao_por_rowid)
+        if not posicoes_var:
+            sem_candidatos.append(posicao)
+            continue
+        resultado = sugerir_em_lote([consulta], [lista_busca[i] for i in posicoes_var], top_n, score_minimo)[0]
+        sugestoes[posicao] = [(posicoes_var[i], score) for i, score in resultado]
+    for posicao, resultado in zip(sem_candidatos, sugerir_em_lote([consultas[p] for p in sem_candidatos], lista_busca, top_n, score_minimo)):
+        sugestoes[posicao] = resultado
+    return sugestoes
+
+def sugerir_por_hierarquia(consultas, escopos, catalogo, top_n, score_minimo, ao_avancar=None, buscar_candidatos=None):
+    indice = catalogo['indice']
+    sugestoes = [[] for _ in consultas]
+
+    grupos = {}
+    for posicao, escopo in enumerate(escopos):
+        grupos.setdefault(escopo, []).append(posicao)
+
+    sem_escopo = grupos.pop(None, [])
+    for posicao, resultado in zip(sem_escopo, _sugerir_no_modulo([consultas[p] for p in sem_escopo], catalogo['lista_norm'], catalogo, top_n, score_minimo, buscar_candidatos)):
+        sugestoes[posicao] = resultado
+    if ao_avancar:
+        ao_avancar(len(sem_escopo))
+
+    # Sem o código: o prefixo [xx.xx.] comum ao ramo inflaria o score dos vizinhos.
+    lista_sem_codigo = indice['nomes_sem_codigo']
+    sem_codigo = {posicao: PADRAO_CODIGO_VAR.sub('', consultas[posicao]) for posicoes in grupos.values() for posicao in posicoes}
+    do_modulo = dict(zip(sem_codigo, _sugerir_no_modulo(list(sem_codigo.values()), lista_sem_codigo, catalogo, top_n, score_minimo, buscar_candidatos)))
+    for escopo, posicoes in grupos.items():
+        posicoes_ramo = indice['subarvores'][escopo]
+        no_ramo = set(posicoes_ramo.tolist())
+        do_ramo = sugerir_em_lote([sem_codigo[p] for p in posicoes], [lista_sem_codigo[i] for i in posicoes_ramo], top_n, score_minimo)
+        for posicao, sugestoes_ramo in zip(posicoes, do_ramo):
+            candidatos = {int(i): score for i, score in do_modulo[posicao]}
+            candidatos.update((int(posicoes_ramo[i]), score) for i, score in sugestoes_ramo)
+            sugestoes[posicao] = sorted(candidatos.items(), key=lambda par: (-(par[1] + (FOLGA_ESCOPO if par[0] in no_ramo else 0)), par[0]))[:top_n]
+        if ao_avancar:
+            ao_avancar(len(posicoes))
+    return sugestoes
 
-def analisar_riscos_excel(caminho_arquivo, cenario):
+# --- MOTOR DE COMPARAÇÃO EM LOTE ---
+def sugerir_em_lote(consultas, lista_var_norm, top_n, score_minimo):
+    sugestoes = [[] for _ in consultas]
+    if not consultas or not lista_var_norm:
+        return sugestoes
+
+    consultas_unicas = list(dict.fromkeys(consultas))
+    sugestoes_unicas = {}
+    k = min(top_n, len(lista_var_norm))
+    tamanho_bloco = max(1, MAX_CELULAS_CDIST // len(lista_var_norm))
+    for inicio in range(0, len(consultas_unicas), tamanho_bloco):
+        bloco = consultas_unicas[inicio:inicio + tamanho_bloco]
+        matriz = process.cdist(bloco, lista_var_norm, scorer=fuzz.WRatio, score_cutoff=score_minimo, dtype=np.float32, workers=-1)
+        contar('validador_fuzzy_chamadas_total')
+        contar('validador_fuzzy_comparacoes_total', len(bloco) * len(lista_var_norm))
+        candidatos = np.argpartition(-matriz, k - 1, axis=1)[:, :k] if k < matriz.shape[1] else np.tile(np.arange(matriz.shape[1]), (len(bloco), 1))
+        for linha, consulta in enumerate(bloco):
+            indices = candidatos[linha]
+            if k < matriz.shape[1]:
+                # Empate no k-ésimo score: fica com os de menor índice, não com o que o argpartition escolheu.
+                limite = matriz[linha, indices].min()
+                acima = indices[matriz[linha, indices] > limite]
+                empatados = np.flatnonzero(matriz[linha] == limite)[:k - len(acima)]
+                indices = np.concatenate([acima, empatados])
+            scores = matriz[linha, indices]
+            ordem = np.lexsort((indices, -scores))
+            sugestoes_unicas[consulta] = [(int(indices[i]), float(scores[i])) for i in ordem if scores[i] > 0 and scores[i] >= score_minimo]
+
+    return [sugestoes_unicas[consulta] for consulta in consultas]
+
+def ler_parametro_int(nome, padrao, minimo, maximo):
+    valor = request.values.get(nome, '')
+    if str(valor).strip() == '':
+        return padrao
     try:
+        valor = int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"O parâmetro '{nome}' deve ser um número inteiro.")
+    if not minimo <= valor <= maximo:
+        raise ValueError(f"O parâmetro '{nome}' deve estar entre {minimo} e {maximo}.")
+    return valor
+
+# --- LÓGICA DO ANALISADOR DE RISCOS SoD (Atualizada) ---
+
+TITULO_RELATORIO_SOD = "Relatório da Análise de ticket do perfil"
+TITULO_RISCOS_SOD = "Riscos SoD para perfil"
+# Colunas mescladas do export do GRC: (nome, coluna inicial, coluna final exclusiva).
+GRUPOS_RELATORIO_SOD = [('Perfil', 0, 2), ('Sistema', 2, 4), ('Funcionalidade', 4, 8), ('Status', 8, 10)]
+GRUPOS_RISCOS_SOD = [
+    ('ID Risco', 0, 2), ('Descrição Risco', 2, 6), ('Criticidade', 6, 8), ('Aprovador', 8, 10),
+    ('Sistema', 10, 12), ('Módulo', 12, 14), ('Atividade', 14, 16), ('Funcionalidade', 16, 18),
+    ('Atividade2', 18, 20), ('Funcionalidade 2', 20, 22)
+]
+LARGURA_RELATORIO_SOD = GRUPOS_RELATORIO_SOD[-1][2]
+LARGURA_RISCOS_SOD = GRUPOS_RISCOS_SOD[-1][2]
+
+def iterar_linhas_excel(caminho_arquivo):
+    if caminho_arquivo.lower().endswith('.xls'):
         df_bruto = pd.read_excel(caminho_arquivo, header=None, sheet_name=0)
+        yield from df_bruto.astype(object).where(df_bruto.notna(), None).itertuples(index=False, name=None)
+        return
+    workbook = openpyxl.load_workbook(caminho_arquivo, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def _texto_celulas(linha, largura):
+    valores = ['' if valor is None else str(valor) for valor in linha[:largura]]
+    return valores + [''] * (largura - len(valores))
+
+def ler_tabelas_sod(caminho_arquivo):
+    titulo_t1 = None
+    linha_titulo_t1 = linha_titulo_t2 = None
+    linhas_t1, linhas_t2 = [], []
+    linhas = iterar_linhas_excel(caminho_arquivo)
+    try:
+        for indice, linha in enumerate(linhas):
+            primeira_celula = '' if not linha or linha[0] is None else str(linha[0])
+            if linha_titulo_t2 is None:
+                if linha_titulo_t1 is None and TITULO_RELATORIO_SOD in primeira_celula:
+                    linha_titulo_t1, titulo_t1 = indice, primeira_celula
+                elif TITULO_RISCOS_SOD in primeira_celula:
+                    linha_titulo_t2 = indice
+                    # A linha logo acima do título da Tabela 2 é o separador entre as tabelas.
+                    if linhas_t1 and linhas_t1[-1][0] == indice - 1:
+                        linhas_t1.pop()
+                elif linha_titulo_t1 is not None and indice >= linha_titulo_t1 + 2:
+                    linhas_t1.append((indice, _texto_celulas(linha, LARGURA_RELATORIO_SOD)))
+            elif indice >= linha_titulo_t2 + 2:
+                celulas = _texto_celulas(linha, LARGURA_RISCOS_SOD)
+                if not any(celula.strip() for celula in celulas):
+                    break
+                linhas_t2.append(celulas)
+    finally:
+        linhas.close()
+    return {
+        'linha_titulo_t1': linha_titulo_t1, 'titulo_t1': titulo_t1, 'linha_titulo_t2': linha_titulo_t2,
+        'linhas_t1': [celulas for _, celulas in linhas_t1], 'linhas_t2': linhas_t2,
+    }
+
+def consolidar_grupos(linhas, grupos, largura):
+    matriz = np.array(linhas, dtype=object).reshape(len(linhas), largura)
+    return pd.DataFrame({nome: functools.reduce(np.add, (matriz[:, coluna] for coluna in range(inicio, fim))) if len(linhas) else [] for nome, inicio, fim in grupos})
+
+# --- MATRIZ DE RISCOS SoD ---
+def indexar_riscos(riscos, funcionalidades):
+    ocorrencias = []
+    for risco in riscos:
+        lado_1, lado_2 = str(risco['Funcionalidade']).strip(), str(risco['Funcionalidade 2']).strip()
+        if lado_1 in funcionalidades:
+            ocorrencias.append({'funcionalidade': lado_1, 'conflitante': lado_2, 'risco': risco})
+        if lado_2 in funcionalidades and lado_2 != lado_1:
+            ocorrencias.append({'funcionalidade': lado_2, 'conflitante': lado_1, 'risco': risco})
+    return ocorrencias
+
+def buscar_riscos_matriz(conn, matriz_id, funcionalidades):
+    colunas = ', '.join(f'r."{nome}"' for nome, _, _ in GRUPOS_RISCOS_SOD)
+    linhas = conn.execute(f'''
+        SELECT f.funcionalidade, f.conflitante, {colunas}
+        FROM riscos_sod_funcionalidade f JOIN riscos_sod r ON r.id = f.risco_id
+        WHERE f.matriz_id = ? AND f.funcionalidade IN (SELECT value FROM json_each(?))
+        ORDER BY r.id
+    ''', (matriz_id, json.dumps(sorted(funcionalidades)))).fetchall()
+    return [{'funcionalidade': linha['funcionalidade'], 'conflitante': linha['conflitante'], 'risco': {nome: linha[nome] for nome, _, _ in GRUPOS_RISCOS_SOD}} for linha in linhas]
+
+def listar_historico_matrizes(conn, pagina=1, tamanho_pagina=HISTORICO_POR_PAGINA):
+    total = conn.execute('SELECT COUNT(*) FROM matrizes_risco_historico').fetchone()[0]
+    rows = conn.execute('''
+        SELECT id, nome_arquivo_original, status, total_riscos, COALESCE(strftime('%d/%m/%Y às %H:%M', timestamp), '') AS timestamp_formatado
+        FROM matrizes_risco_historico ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?
+    ''', (tamanho_pagina, (pagina - 1) * tamanho_pagina)).fetchall()
+    return {'total': total, 'pagina': pagina, 'tamanho_pagina': tamanho_pagina, 'total_paginas': -(-total // tamanho_pagina),
+            'itens': [dict(row) for row in rows]}
+
+def obter_matriz_risco_ativa(conn):
+    row = conn.execute('SELECT id FROM matrizes_risco_historico WHERE status = "Ativo" ORDER BY id DESC LIMIT 1').fetchone()
+    return row['id'] if row else None
+
+def ler_matriz_riscos(caminho_arquivo):
+    tabelas = ler_tabelas_sod(caminho_arquivo)
+    if tabelas['linha_titulo_t2'] is not None:
+        return consolidar_grupos(tabelas['linhas_t2'], GRUPOS_RISCOS_SOD, LARGURA_RISCOS_SOD)
+    colunas = [nome for nome, _, _ in GRUPOS_RISCOS_SOD]
+    df = pd.read_excel(caminho_arquivo, dtype=str)
+    if not all(coluna in df.columns for coluna in colunas):
+        raise ValueError(f"Colunas esperadas não encontradas: {', '.join(colunas)}.")
+    return df[colunas].fillna('')
+
+def carregar_matriz_riscos(conn, df_matriz, nome_arquivo_original):
+    df_matriz = df_matriz[(df_matriz['Funcionalidade'].str.strip() != '') | (df_matriz['Funcionalidade 2'].str.strip() != '')]
+    cursor = conn.execute('INSERT INTO matrizes_risco_historico (nome_arquivo_original, timestamp, status, total_riscos) VALUES (?, ?, "Válido", ?)', (nome_arquivo_original, datetime.now(), len(df_matriz)))
+    matriz_id = cursor.lastrowid
+    colunas = [nome for nome, _, _ in GRUPOS_RISCOS_SOD]
+    conn.executemany(
+        f'INSERT INTO riscos_sod (matriz_id, {", ".join(f"{chr(34)}{nome}{chr(34)}" for nome in colunas)}) VALUES (?{", ?" * len(colunas)})',
+        ((matriz_id, *valores) for valores in df_matriz[colunas].itertuples(index=False, name=None))
+    )
+    conn.execute('''
+        INSERT INTO riscos_sod_funcionalidade (matriz_id, funcionalidade, risco_id, conflitante)
+        SELECT matriz_id, TRIM("Funcionalidade"), id, TRIM("Funcionalidade 2") FROM riscos_sod WHERE matriz_id = ? AND TRIM("Funcionalidade") != ''
+        UNION ALL
+        SELECT matriz_id, TRIM("Funcionalidade 2"), id, TRIM("Funcionalidade") FROM riscos_sod WHERE matriz_id = ? AND TRIM("Funcionalidade 2") != '' AND TRIM("Funcionalidade 2") != TRIM("Funcionalidade")
+    ''', (matriz_id, matriz_id))
+    return matriz_id
+
+def ativar_matriz_riscos(conn, matriz_id):
+    conn.execute('UPDATE matrizes_risco_historico SET status = "Arquivado" WHERE status = "Ativo"')
+    conn.execute('UPDATE matrizes_risco_historico SET status = "Ativo" WHERE id = ?', (matriz_id,))
+
+def analisar_riscos_excel(caminho_arquivo, cenario, matriz_id=None):
+    try:
+        with medir('sod_leitura_excel'):
+            tabelas = ler_tabelas_sod(caminho_arquivo)
+        contar('validador_linhas_processadas_total', len(tabelas['linhas_t1']) + len(tabelas['linhas_t2']), operacao='analisar_sod')
     except Exception as e:
         return {'status': 'error', 'message': f"Erro ao ler o arquivo Excel: {e}", 'cenario': cenario}
 
-    linha_titulo_t1 = encontrar_linha_titulo(df_bruto, "Relatório da Análise de ticket do perfil")
-    linha_titulo_t2 = encontrar_linha_titulo(df_bruto, "Riscos SoD para perfil")
+    linha_titulo_t1 = tabelas['linha_titulo_t1']
+    linha_titulo_t2 = tabelas['linha_titulo_t2']
 
     if (cenario == 'manutencao' and linha_titulo_t1 is None) or linha_titulo_t2 is None:
         return {'status': 'error', 'message': "Não foi possível encontrar os títulos das tabelas necessárias para este cenário.", 'cenario': cenario}
@@ -85,28 +995,15 @@ def analisar_riscos_excel(caminho_arquivo, cenario):
     perfil_analisado = "Não identificado"
     if linha_titulo_t1 is not None:
         try:
-            titulo_completo_t1 = df_bruto.iloc[linha_titulo_t1, 0]
-            match = re.search(r"Relatório da Análise de ticket do perfil\s*(.*)", titulo_completo_t1, re.IGNORECASE)
+            match = re.search(r"Relatório da Análise de ticket do perfil\s*(.*)", tabelas['titulo_t1'], re.IGNORECASE)
             if match:
                 perfil_analisado = match.group(1).strip()
         except Exception:
             pass
     
     try:
-        dados_t2_bruto = df_bruto.iloc[linha_titulo_t2 + 2 :]
-        riscos_data = {
-            'ID Risco': consolidar_colunas(dados_t2_bruto, 0, 2),
-            'Descrição Risco': consolidar_colunas(dados_t2_bruto, 2, 6),
-            'Criticidade': consolidar_colunas(dados_t2_bruto, 6, 8),
-            'Aprovador': consolidar_colunas(dados_t2_bruto, 8, 10),
-            'Sistema': consolidar_colunas(dados_t2_bruto, 10, 12),
-            'Módulo': consolidar_colunas(dados_t2_bruto, 12, 14),
-            'Atividade': consolidar_colunas(dados_t2_bruto, 14, 16),
-            'Funcionalidade': consolidar_colunas(dados_t2_bruto, 16, 18),
-            'Atividade2': consolidar_colunas(dados_t2_bruto, 18, 20),
-            'Funcionalidade 2': consolidar_colunas(dados_t2_bruto, 20, 22)
-        }
-        df_riscos = pd.DataFrame(riscos_data).dropna(how='all')
+        with medir('sod_consolidacao_riscos'):
+            df_riscos = consolidar_grupos(tabelas['linhas_t2'], GRUPOS_RISCOS_SOD, LARGURA_RISCOS_SOD)
     except Exception as e:
         return {'status': 'error', 'message': f"Erro ao reconstruir a Tabela 2 (Riscos). Detalhes: {e}", 'perfil': perfil_analisado, 'cenario': cenario}
 
@@ -120,14 +1017,8 @@ def analisar_riscos_excel(caminho_arquivo, cenario):
 
     elif cenario == 'manutencao':
         try:
-            dados_t1_bruto = df_bruto.iloc[linha_titulo_t1 + 2 : linha_titulo_t2 - 1]
-            relatorio_data = {
-                'Perfil': consolidar_colunas(dados_t1_bruto, 0, 2),
-                'Sistema': consolidar_colunas(dados_t1_bruto, 2, 4),
-                'Funcionalidade': consolidar_colunas(dados_t1_bruto, 4, 8),
-                'Status': consolidar_colunas(dados_t1_bruto, 8, 10)
-            }
-            df_relatorio = pd.DataFrame(relatorio_data).dropna(how='all')
+            with medir('sod_consolidacao_relatorio'):
+                df_relatorio = consolidar_grupos(tabelas['linhas_t1'], GRUPOS_RELATORIO_SOD, LARGURA_RELATORIO_SOD)
         except Exception as e:
             return {'status': 'error', 'message': f"Erro ao reconstruir a Tabela 1 (Relatório). Detalhes: {e}", 'perfil': perfil_analisado, 'cenario': cenario}
         
@@ -135,30 +1026,334 @@ def analisar_riscos_excel(caminho_arquivo, cenario):
         if df_adicionadas.empty:
             return {'status': 'no_risks', 'message': "Nenhuma funcionalidade com status 'Adicionado' foi encontrada para análise.", 'perfil': perfil_analisado, 'cenario': cenario}
         
-        funcionalidades_para_verificar = df_adicionadas['Funcionalidade'].dropna().unique()
-        riscos_encontrados = df_riscos[
-            df_riscos['Funcionalidade'].isin(funcionalidades_para_verificar) |
-            df_riscos['Funcionalidade 2'].isin(funcionalidades_para_verificar)
-        ].copy()
+        funcionalidades_adicionadas = set(df_adicionadas['Funcionalidade'].str.strip()) - {''}
+        with medir('sod_busca_riscos'):
+            if matriz_id is not None:
+                presentes = set(df_relatorio.loc[df_relatorio['Status'].str.strip() != 'Removido', 'Funcionalidade'].str.strip())
+                ocorrencias = [
+                    ocorrencia for ocorrencia in buscar_riscos_matriz(get_db_connection(somente_leitura=True), matriz_id, funcionalidades_adicionadas)
+                    if ocorrencia['conflitante'] in presentes or ocorrencia['conflitante'] in funcionalidades_adicionadas
+                ]
+            else:
+                ocorrencias = indexar_riscos(df_riscos.to_dict('records'), funcionalidades_adicionadas)
 
-        if riscos_encontrados.empty:
+        if not ocorrencias:
             return {'status': 'no_risks', 'message': "As funcionalidades adicionadas não apresentaram riscos SoD.", 'perfil': perfil_analisado, 'cenario': cenario}
-        else:
-            resultado_detalhado = pd.merge(df_adicionadas, riscos_encontrados, left_on='Funcionalidade', right_on='Funcionalidade', how='inner')
-            resultado_detalhado.rename(columns={'Sistema_x': 'Sistema'}, inplace=True)
-            modulos_encontrados = resultado_detalhado['Módulo'].dropna().unique().tolist()
-            modulos_str = ", ".join(modulos_encontrados)
-            
-            dados_agrupados = {}
-            for index, row in resultado_detalhado.iterrows():
-                func = row['Funcionalidade']
-                if func not in dados_agrupados: dados_agrupados[func] = []
-                dados_agrupados[func].append({
-                    'ID Risco': row['ID Risco'], 'Descrição Risco': row['Descrição Risco'], 'Criticidade': row['Criticidade'],
-                    'Perfil': row['Perfil'], 'Sistema': row['Sistema']
+
+        linhas_por_funcionalidade = {}
+        for linha in df_adicionadas[['Perfil', 'Sistema', 'Funcionalidade']].itertuples(index=False):
+            linhas_por_funcionalidade.setdefault(linha.Funcionalidade.strip(), []).append(linha)
+
+        dados_agrupados = {}
+        modulos_encontrados = []
+        conflitos_entre_adicionadas = set()
+        for ocorrencia in ocorrencias:
+            func, risco = ocorrencia['funcionalidade'], ocorrencia['risco']
+            entre_adicionadas = ocorrencia['conflitante'] in funcionalidades_adicionadas
+            if entre_adicionadas:
+                conflitos_entre_adicionadas.add(risco['ID Risco'])
+            if risco['Módulo'] and risco['Módulo'] not in modulos_encontrados:
+                modulos_encontrados.append(risco['Módulo'])
+            for linha in linhas_por_funcionalidade.get(func, []):
+                dados_agrupados.setdefault(func, []).append({
+                    'ID Risco': risco['ID Risco'], 'Descrição Risco': risco['Descrição Risco'], 'Criticidade': risco['Criticidade'],
+                    'Perfil': linha.Perfil, 'Sistema': linha.Sistema,
+                    'Funcionalidade': risco['Funcionalidade'], 'Funcionalidade 2': risco['Funcionalidade 2'],
+                    'Entre adicionadas': entre_adicionadas
                 })
-            
-            return {'status': 'success', 'message': "Atenção! Foram encontrados os seguintes riscos para as funcionalidades adicionadas:", 'data': dados_agrupados, 'perfil': perfil_analisado, 'modulos': modulos_str, 'cenario': cenario}
+
+        mensagem = "Atenção! Foram encontrados os seguintes riscos para as funcionalidades adicionadas:"
+        if conflitos_entre_adicionadas:
+            mensagem = f"Atenção! Foram encontrados os seguintes riscos para as funcionalidades adicionadas, incluindo {len(conflitos_entre_adicionadas)} conflito(s) entre duas funcionalidades adicionadas neste ticket:"
+        return {'status': 'success', 'message': mensagem, 'data': dados_agrupados, 'perfil': perfil_analisado, 'modulos': ", ".join(modulos_encontrados), 'cenario': cenario, 'matriz_id': matriz_id}
+
+# --- ANÁLISE SoD EM LOTE ---
+_pool_sod = None
+_pool_sod_lock = threading.Lock()
+
+def obter_pool_sod():
+    # forkserver: os workers não herdam por fork o estado das threads de tarefas (locks, conexões).
+    global _pool_sod
+    with _pool_sod_lock:
+        if _pool_sod is None:
+            _pool_sod = ProcessPoolExecutor(max_workers=SOD_LOTE_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+        return _pool_sod
+
+def descartar_pool_sod(pool):
+    global _pool_sod
+    with _pool_sod_lock:
+        if _pool_sod is pool:
+            _pool_sod = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def enviar_ao_pool_sod(*args):
+    pool = obter_pool_sod()
+    try:
+        return pool.submit(_analisar_arquivo_lote, *args), pool
+    except BrokenProcessPool:
+        descartar_pool_sod(pool)
+        pool = obter_pool_sod()
+        return pool.submit(_analisar_arquivo_lote, *args), pool
+
+def salvar_upload_temporario(origem, nome_arquivo, pasta):
+    descritor, caminho = tempfile.mkstemp(suffix=os.path.splitext(nome_arquivo)[1].lower(), dir=pasta)
+    sha256 = hashlib.sha256()
+    with os.fdopen(descritor, 'wb') as destino:
+        for bloco in iter(lambda: origem.read(1024 * 1024), b''):
+            sha256.update(bloco)
+            destino.write(bloco)
+    return caminho, sha256.hexdigest()
+
+def extrair_arquivos_lote(arquivos, pasta):
+    extraidos = []
+    membros_zip, bytes_zip = 0, 0
+    for arquivo in arquivos:
+        nome = secure_filename(arquivo.filename or '')
+        if nome.lower().endswith('.zip'):
+            with zipfile.ZipFile(arquivo.stream) as pacote:
+                membros = [
+                    membro for membro in pacote.infolist()
+                    if not membro.is_dir() and not membro.filename.startswith('__MACOSX') and allowed_file(os.path.basename(membro.filename))
+                ]
+                # Pelo diretório central, antes de descompactar; a leitura não passa do file_size declarado.
+                membros_zip += len(membros)
+                bytes_zip += sum(membro.file_size for membro in membros)
+                if membros_zip > MAX_ARQUIVOS_ZIP:
+                    raise ValueError(f"O lote tem mais de {MAX_ARQUIVOS_ZIP} planilhas dentro de arquivos .zip.")
+                if bytes_zip > MAX_BYTES_ZIP_DESCOMPACTADO:
+                    raise ValueError(f"As planilhas dos arquivos .zip passam de {MAX_BYTES_ZIP_DESCOMPACTADO // (1024 * 1024)} MB descompactadas.")
+                for membro in membros:
+                    nome_membro = os.path.basename(membro.filename)
+                    with pacote.open(membro) as origem:
+                        extraidos.append((nome_membro, *salvar_upload_temporario(origem, nome_membro, pasta)))
+        elif allowed_file(nome):
+            extraidos.append((nome, *salvar_upload_temporario(arquivo.stream, nome, pasta)))
+    return extraidos
+
+def chave_cache_sod(sha256_arquivo, cenario, matriz_id):
+    return chave_cache('sod', sha256_arquivo, cenario=cenario, matriz_id=matriz_id)
+
+def analisar_sod_com_cache(caminho_arquivo, sha256_arquivo, cenario, matriz_id, consultar_cache=True):
+    chave = chave_cache_sod(sha256_arquivo, cenario, matriz_id)
+    resultado = ler_cache_resultado(chave, 'sod') if consultar_cache else None
+    if resultado is not None:
+        resultado['cache'] = True
+        return resultado
+    resultado = analisar_riscos_excel(caminho_arquivo, cenario, matriz_id)
+    if resultado['status'] != 'error':
+        gravar_cache_resultado(chave, 'sod', resultado)
+    resultado['cache'] = False
+    return resultado
+
+def _analisar_arquivo_lote(caminho_arquivo, nome_arquivo, cenario, matriz_id):
+    inicio = time.perf_counter()
+    try:
+        resultado = analisar_riscos_excel(caminho_arquivo, cenario, matriz_id)
+    except Exception as e:
+        resultado = {'status': 'error', 'message': f"Falha inesperada ao analisar o arquivo: {e}", 'cenario': cenario}
+    resultado['nome_arquivo'] = nome_arquivo
+    resultado['tempo_segundos'] = round(time.perf_counter() - inicio, 3)
+    resultado['total_riscos'] = sum(len(riscos) for riscos in resultado.get('data', {}).values())
+    descarregar_metricas()
+    return resultado
+
+def preparar_lote_sod(arquivos):
+    pasta_temporaria = tempfile.mkdtemp(prefix='lote_sod_', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        return pasta_temporaria, extrair_arquivos_lote(arquivos, pasta_temporaria)
+    except Exception:
+        shutil.rmtree(pasta_temporaria, ignore_errors=True)
+        raise
+
+def processar_lote_sod(pasta_temporaria, extraidos, cenario, matriz_id, progresso=None):
+    inicio = time.perf_counter()
+    try:
+        resultados = [None] * len(extraidos)
+        futuros = {}
+        for posicao, (nome, caminho, sha256_arquivo) in enumerate(extraidos):
+            inicio_arquivo = time.perf_counter()
+            resultado = ler_cache_resultado(chave_cache_sod(sha256_arquivo, cenario, matriz_id), 'sod')
+            if resultado is None:
+                futuro, pool = enviar_ao_pool_sod(caminho, nome, cenario, matriz_id)
+                futuros[futuro] = (posicao, pool)
+                continue
+            resultado.update({'nome_arquivo': nome, 'cache': True, 'tempo_segundos': round(time.perf_counter() - inicio_arquivo, 3)})
+            resultado['total_riscos'] = sum(len(riscos) for riscos in resultado.get('data', {}).values())
+            resultados[posicao] = resultado
+
+        concluidos = len(extraidos) - len(futuros)
+        for futuro in as_completed(futuros):
+            posicao, pool = futuros[futuro]
+            try:
+                resultado = futuro.result()
+            except BrokenProcessPool:
+                app.logger.error("Worker do pool SoD encerrado durante o lote", exc_info=True)
+                descartar_pool_sod(pool)
+                resultado = {
+                    'status': 'error', 'message': "O processo que analisava este arquivo foi encerrado inesperadamente. Envie o arquivo novamente.",
+                    'cenario': cenario, 'nome_arquivo': extraidos[posicao][0], 'tempo_segundos': 0, 'total_riscos': 0,
+                }
+            if resultado['status'] != 'error':
+                gravar_cache_resultado(chave_cache_sod(extraidos[posicao][2], cenario, matriz_id), 'sod', {chave: valor for chave, valor in resultado.items() if chave not in ('nome_arquivo', 'tempo_segundos', 'total_riscos')})
+            resultado['cache'] = False
+            resultados[posicao] = resultado
+            concluidos += 1
+            if progresso:
+                progresso('Analisando arquivos', concluidos, len(extraidos))
+    finally:
+        shutil.rmtree(pasta_temporaria, ignore_errors=True)
+    return {'cenario': cenario, 'arquivos': resultados, 'tempo_total': round(time.perf_counter() - inicio, 3), 'relatorio': gerar_relatorio_lote_sod(resultados, cenario) if resultados else None}
+
+PADRAO_RELATORIO_SOD = re.compile(r'Relatorio_Lote_SoD_\d{8}_\d{6}_[0-9a-f]{6}\.xlsx')
+
+def limpar_relatorios_sod():
+    pasta = app.config['RELATORIOS_SOD_FOLDER']
+    os.makedirs(pasta, exist_ok=True)
+    limite = time.time() - RELATORIOS_SOD_RETENCAO_DIAS * 86400
+    for entrada in os.scandir(pasta):
+        if PADRAO_RELATORIO_SOD.fullmatch(entrada.name) and entrada.stat().st_mtime < limite:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entrada.path)
+
+def gerar_relatorio_lote_sod(resultados, cenario):
+    resumo = [{
+        'Arquivo': r['nome_arquivo'], 'Perfil': r.get('perfil', ''), 'Cenário': 'Criação' if cenario == 'criacao' else 'Manutenção',
+        'Status': r['status'], 'Mensagem': r['message'], 'Riscos': r['total_riscos'], 'Tempo (s)': r['tempo_segundos']
+    } for r in resultados]
+    riscos = [
+        {'Arquivo': r['nome_arquivo'], 'Perfil Analisado': r.get('perfil', ''), 'Grupo': grupo, **risco}
+        for r in resultados for grupo, itens in r.get('data', {}).items() for risco in itens
+    ]
+    limpar_relatorios_sod()
+    nome_relatorio = f"Relatorio_Lote_SoD_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(3).hex()}.xlsx"
+    with pd.ExcelWriter(os.path.join(app.config['RELATORIOS_SOD_FOLDER'], nome_relatorio), engine='xlsxwriter') as writer:
+        pd.DataFrame(resumo).to_excel(writer, index=False, sheet_name='Resumo')
+        pd.DataFrame(riscos).to_excel(writer, index=False, sheet_name='Riscos')
+    return nome_relatorio
+
+# --- TAREFAS EM SEGUNDO PLANO ---
+# Threads do próprio processo; o estado fica em `tarefas` e o dono renova atualizado_em enquanto roda.
+_executor_tarefas = ThreadPoolExecutor(max_workers=TAREFAS_WORKERS, thread_name_prefix='tarefa')
+_tarefas_do_processo = set()
+_tarefas_lock = threading.Lock()
+_sinal_tarefas_pid = None
+
+def pedido_assincrono():
+    return str(request.values.get('assincrono', '')).lower() in ('1', 'true', 'sim')
+
+def atualizar_tarefa(tarefa_id, **campos):
+    campos['atualizado_em'] = datetime.now()
+    conn = get_db_connection()
+    conn.execute(f"UPDATE tarefas SET {', '.join(f'{campo} = ?' for campo in campos)} WHERE id = ?", (*campos.values(), tarefa_id))
+    conn.commit()
+
+def criar_tarefa(tipo, funcao, *args):
+    # `funcao` devolve um dict; a chave 'erro' marca a tarefa como falha.
+    tarefa_id = uuid.uuid4().hex
+    agora = datetime.now()
+    conn = get_db_connection()
+    conn.execute('DELETE FROM tarefas WHERE atualizado_em < ?', (agora - timedelta(days=TAREFAS_RETENCAO_DIAS),))
+    conn.execute('INSERT INTO tarefas (id, tipo, status, etapa, criado_em, atualizado_em, pid) VALUES (?, ?, "Na fila", "Aguardando execução", ?, ?, ?)', (tarefa_id, tipo, agora, agora, os.getpid()))
+    conn.commit()
+    with _tarefas_lock:
+        _tarefas_do_processo.add(tarefa_id)
+    iniciar_sinal_tarefas()
+    _executor_tarefas.submit(_executar_tarefa, tarefa_id, funcao, args)
+    return tarefa_id
+
+def iniciar_sinal_tarefas():
+    global _sinal_tarefas_pid
+    with _tarefas_lock:
+        if _sinal_tarefas_pid == os.getpid():
+            return
+        _sinal_tarefas_pid = os.getpid()
+    threading.Thread(target=_renovar_sinal_tarefas, name='sinal-tarefas', daemon=True).start()
+
+def _renovar_sinal_tarefas():
+    while True:
+        time.sleep(TAREFAS_SINAL_SEGUNDOS)
+        with _tarefas_lock:
+            ids = list(_tarefas_do_processo)
+        if not ids:
+            continue
+        try:
+            conn = get_db_connection()
+            conn.execute("UPDATE tarefas SET atualizado_em = ? WHERE id IN (SELECT value FROM json_each(?)) AND status IN ('Na fila', 'Executando')",
+                         (datetime.now(), json.dumps(ids)))
+            conn.commit()
+        except sqlite3.Error:
+            app.logger.warning("Não foi possível renovar o sinal das tarefas", exc_info=True)
+
+def _executar_tarefa(tarefa_id, funcao, args):
+    ultima_gravacao = [0.0]
+    def progresso(etapa, feitos=None, total=None):
+        # No máximo duas escritas por segundo, fora mudanças de etapa.
+        agora = time.monotonic()
+        if feitos and total and feitos < total and agora - ultima_gravacao[0] < 0.5:
+            return
+        ultima_gravacao[0] = agora
+        atualizar_tarefa(tarefa_id, status='Executando', etapa=etapa, progresso=feitos, total=total)
+
+    atualizar_tarefa(tarefa_id, status='Executando', etapa='Iniciando')
+    try:
+        resultado = funcao(*args, progresso=progresso)
+    except Exception as e:
+        liberar_conexoes()
+        app.logger.error(f"Falha na tarefa {tarefa_id}", exc_info=True)
+        atualizar_tarefa(tarefa_id, status='Falhou', etapa='Erro', erro=f"Falha interna ao executar a tarefa: {e}")
+        return
+    finally:
+        with _tarefas_lock:
+            _tarefas_do_processo.discard(tarefa_id)
+        descarregar_metricas()
+    liberar_conexoes()
+    if resultado.get('erro'):
+        atualizar_tarefa(tarefa_id, status='Falhou', etapa='Erro', erro=resultado['erro'])
+    else:
+        atualizar_tarefa(tarefa_id, status='Concluída', etapa='Concluída', resultado=json.dumps(resultado, ensure_ascii=False, default=str))
+
+def obter_tarefa(tarefa_id):
+    return get_db_connection().execute('SELECT * FROM tarefas WHERE id = ?', (tarefa_id,)).fetchone()
+
+def processo_ativo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def tarefa_perdida(tarefa):
+    if tarefa['status'] not in ('Na fila', 'Executando'):
+        return False
+    if tarefa['pid'] is not None and tarefa['pid'] != os.getpid() and not processo_ativo(tarefa['pid']):
+        return True
+    return datetime.fromisoformat(tarefa['atualizado_em']) < datetime.now() - timedelta(seconds=TAREFAS_SEM_SINAL_SEGUNDOS)
+
+def resposta_tarefa_criada(tarefa_id):
+    return jsonify({'tarefa_id': tarefa_id, 'status': 'Na fila', 'url_status': url_for('status_tarefa', tarefa_id=tarefa_id)}), 202
+
+@app.route('/tarefas/<tarefa_id>')
+def status_tarefa(tarefa_id):
+    tarefa = obter_tarefa(tarefa_id)
+    if not tarefa:
+        return jsonify({'erro': 'Tarefa não encontrada.'}), 404
+    if tarefa_perdida(tarefa):
+        conn = get_db_connection()
+        conn.execute("UPDATE tarefas SET status = 'Falhou', etapa = 'Erro', erro = ? WHERE id = ? AND status IN ('Na fila', 'Executando')",
+                     ('A tarefa foi interrompida porque o processo que a executava foi reiniciado. Envie o arquivo novamente.', tarefa_id))
+        conn.commit()
+        tarefa = obter_tarefa(tarefa_id)
+    resposta = {
+        'tarefa_id': tarefa['id'], 'tipo': tarefa['tipo'], 'status': tarefa['status'], 'etapa': tarefa['etapa'],
+        'progresso': tarefa['progresso'], 'total': tarefa['total'], 'erro': tarefa['erro']
+    }
+    if tarefa['status'] == 'Concluída':
+        resposta['resultado'] = json.loads(tarefa['resultado'])
+        if tarefa['tipo'] == 'sod_analyzer':
+            resposta['url_resultado'] = url_for('resultado_tarefa_sod', tarefa_id=tarefa_id)
+    return jsonify(resposta)
 
 # --- ROTAS PRINCIPAIS ---
 @app.route('/')
@@ -168,23 +1363,32 @@ def home():
 # --- ROTAS DO VALIDADOR DE PERFIS (sem alterações) ---
 @app.route('/validator')
 def validator():
-    conn = get_db_connection()
-    historico_bruto = conn.execute('SELECT * FROM uploads_historico ORDER BY timestamp DESC').fetchall()
-    historico_formatado = [{'id': row['id'], 'nome_arquivo_original': row['nome_arquivo_original'], 'timestamp_formatado': datetime.fromisoformat(row['timestamp']).strftime('%d/%m/%Y às %H:%M') if row['timestamp'] else '', 'status': row['status']} for row in historico_bruto]
+    conn = get_db_connection(somente_leitura=True)
+    historico = listar_historico_var(conn)
     modulos_disponiveis = []
     is_var_active = False
     try:
-        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='dados_var'").fetchone() and conn.execute('SELECT 1 FROM dados_var').fetchone():
+        if var_ativa_disponivel(conn):
             is_var_active = True
-            modulos_df = pd.read_sql_query('SELECT DISTINCT "Módulo" FROM dados_var', conn)
-            if not modulos_df.empty:
-                modulos_disponiveis = modulos_df["Módulo"].dropna().sort_values().tolist()
+            modulos_disponiveis = list(obter_modulos_var(conn))
     except Exception as e:
         app.logger.warning(f"Não foi possível carregar módulos do DB. Erro: {e}", exc_info=True)
     if not modulos_disponiveis:
         modulos_disponiveis = MODULOS_PADRAO
-    conn.close()
-    return render_template('validator/index.html', historico=historico_formatado, modulos=modulos_disponiveis, is_var_active=is_var_active, active_app='validator')
+    return render_template('validator/index.html', historico=historico['itens'], historico_paginas=historico['total_paginas'], modulos=modulos_disponiveis, is_var_active=is_var_active, active_app='validator')
+
+@app.route('/historico_var')
+def historico_var():
+    try:
+        pagina = ler_parametro_int('pagina', 1, 1, 1_000_000)
+        tamanho_pagina = ler_parametro_int('tamanho_pagina', HISTORICO_POR_PAGINA, 1, 500)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    historico = listar_historico_var(get_db_connection(somente_leitura=True), pagina, tamanho_pagina)
+    for item in historico['itens']:
+        if item['status'] in ('Válido', 'Arquivado'):
+            item['url_ativar'] = url_for('ativar_var', upload_id=item['id'])
+    return jsonify(historico)
 
 @app.route('/upload_var', methods=['POST'])
 def upload_var():
@@ -196,7 +1400,7 @@ def upload_var():
             original_filename = secure_filename(file.filename)
             try:
                 df = pd.read_excel(file)
-                if not all(col in df.columns for col in ["id", "funcionalidade", "modulo id", "modulo"]):
+                if not all(col in df.columns for col in MAPA_COLUNAS_VAR):
                     flash(f"Arquivo inválido! Colunas esperadas não encontradas.", 'danger')
                 else:
                     timestamp = datetime.now()
@@ -205,9 +1409,14 @@ def upload_var():
                     file.seek(0)
                     file.save(filepath)
                     conn = get_db_connection()
-                    conn.execute('INSERT INTO uploads_historico (nome_arquivo_original, nome_arquivo_salvo, timestamp, status) VALUES (?, ?, ?, "Válido")', (original_filename, saved_filename, timestamp))
-                    conn.commit()
-                    conn.close()
+                    try:
+                        with conn:
+                            cursor = conn.execute('INSERT INTO uploads_historico (nome_arquivo_original, nome_arquivo_salvo, timestamp, status) VALUES (?, ?, ?, "Válido")', (original_filename, saved_filename, timestamp))
+                            criar_tabela_var(conn, cursor.lastrowid, df[list(MAPA_COLUNAS_VAR)].rename(columns=MAPA_COLUNAS_VAR))
+                            limpar_tabelas_var(conn)
+                    except Exception:
+                        os.remove(filepath)
+                        raise
                     flash("Arquivo enviado e validado com sucesso!", 'success')
             except Exception as e:
                 flash(f"Erro ao ler o arquivo Excel: {e}", 'danger')
@@ -215,81 +1424,172 @@ def upload_var():
             flash('Tipo de arquivo inválido. Por favor, envie um arquivo .xlsx.', 'danger')
     return redirect(url_for('validator', open_modal='config'))
 
-@app.route('/ativar_var/<int:upload_id>')
-def ativar_var(upload_id):
+def ativar_planilha_var(upload_id, progresso=None):
+    progresso = progresso or (lambda *args, **kwargs: None)
     conn = get_db_connection()
     upload = conn.execute('SELECT * FROM uploads_historico WHERE id = ? AND status IN ("Válido", "Arquivado")', (upload_id,)).fetchone()
-    if upload:
-        try:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], upload['nome_arquivo_salvo'])
-            df = pd.read_excel(filepath)
-            mapa_de_nomes = { "id": "ID Funcionalidade", "funcionalidade": "Funcionalidade", "modulo id": "ID Módulo", "modulo": "Módulo" }
-            df_renomeado = df[list(mapa_de_nomes.keys())].rename(columns=mapa_de_nomes)
-            df_renomeado.to_sql('dados_var', conn, if_exists='replace', index=False)
+    if not upload:
+        return False, "Arquivo para ativação não encontrado ou inválido."
+    try:
+        caminho_planilha = os.path.join(app.config['UPLOAD_FOLDER'], upload['nome_arquivo_salvo'])
+        df = None
+        if not tabela_var_existe(conn, upload_id):
+            # Tabela já descartada: relê a planilha salva.
+            progresso('Lendo planilha VAR')
+            with medir('ativar_leitura_excel'):
+                df = pd.read_excel(caminho_planilha)
+
+        progresso('Ativando VAR')
+        with medir('ativar_troca_view'), transacao(conn):
+            if not tabela_var_existe(conn, upload_id):
+                df = pd.read_excel(caminho_planilha) if df is None else df
+                with medir('ativar_gravacao_sqlite'):
+                    criar_tabela_var(conn, upload_id, df[list(MAPA_COLUNAS_VAR)].rename(columns=MAPA_COLUNAS_VAR))
             conn.execute('UPDATE uploads_historico SET status = "Arquivado" WHERE status = "Ativo"')
             conn.execute('UPDATE uploads_historico SET status = "Ativo" WHERE id = ?', (upload_id,))
-            conn.commit()
-            flash(f"Planilha '{upload['nome_arquivo_original']}' ativada com sucesso!", 'success')
-        except Exception as e:
-            app.logger.error(f"Falha ao ativar a planilha ID {upload_id}", exc_info=True)
-            flash("ERRO AO ATIVAR: Falha ao processar o arquivo.", 'danger')
-            conn.execute('UPDATE uploads_historico SET status = "Inválido" WHERE id = ?', (upload_id,)).commit()
-    else:
-        flash("Arquivo para ativação não encontrado ou inválido.", 'danger')
-    conn.close()
+            apontar_dados_var(conn, upload_id)
+            invalidar_cache_var(conn, upload_id)
+            limpar_tabelas_var(conn)
+    except Exception as e:
+        app.logger.error(f"Falha ao ativar a planilha ID {upload_id}", exc_info=True)
+        conn.rollback()
+        conn.execute('UPDATE uploads_historico SET status = "Inválido" WHERE id = ?', (upload_id,)).connection.commit()
+        return False, "ERRO AO ATIVAR: Falha ao processar o arquivo."
+
+    # A VAR já está ativa; sem aquecimento, o catálogo é montado na próxima comparação.
+    try:
+        with medir('ativar_leitura_sqlite'):
+            df_var = ler_dados_var_completa(conn, upload_id)
+        contar('validador_linhas_processadas_total', len(df_var), operacao='ativar_var')
+        progresso('Montando catálogo', len(df_var), len(df_var))
+        with medir('ativar_catalogo'):
+            trocar_cache_catalogo(upload_id, df_var)
+    except Exception:
+        app.logger.warning(f"Falha ao aquecer o catálogo da planilha ID {upload_id}", exc_info=True)
+        trocar_cache_catalogo(None)
+    return True, f"Planilha '{upload['nome_arquivo_original']}' ativada com sucesso!"
+
+@app.route('/ativar_var/<int:upload_id>')
+def ativar_var(upload_id):
+    if pedido_assincrono():
+        tarefa_id = criar_tarefa('ativar_var', _tarefa_ativar_var, upload_id)
+        return resposta_tarefa_criada(tarefa_id)
+    sucesso, mensagem = ativar_planilha_var(upload_id)
+    flash(mensagem, 'success' if sucesso else 'danger')
     return redirect(url_for('validator', open_modal='config'))
 
-@app.route('/comparar', methods=['POST'])
-def comparar():
+def _tarefa_ativar_var(upload_id, progresso):
+    sucesso, mensagem = ativar_planilha_var(upload_id, progresso)
+    return {'mensagem': mensagem} if sucesso else {'erro': mensagem}
+
+def erro_modulo_comparacao(conn, modulo):
+    if not modulo:
+        return 'Nenhum módulo selecionado para a comparação.'
+    if modulo != MODULO_AUTOMATICO and modulo not in obter_modulos_var(conn):
+        return f"O módulo '{modulo}' não existe na Planilha VAR ativa."
+    return None
+
+def executar_comparacao(conteudo_arquivo, modulo_selecionado, top_n, score_minimo, progresso=None):
+    progresso = progresso or (lambda *args, **kwargs: None)
     try:
-        conn = get_db_connection()
-        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='dados_var'").fetchone() or not conn.execute('SELECT 1 FROM dados_var').fetchone():
-            return jsonify({'erro': 'Nenhuma Planilha VAR está ativa. Por favor, vá para as "Configurações" e ative uma.'}), 400
+        conn = get_db_connection(somente_leitura=True)
+        if not var_ativa_disponivel(conn):
+            return {'erro': 'Nenhuma Planilha VAR está ativa. Por favor, vá para as "Configurações" e ative uma.'}, 400
     except Exception as e:
-        return jsonify({'erro': 'Ocorreu um erro ao verificar a base de dados.'}), 500
+        return {'erro': 'Ocorreu um erro ao verificar a base de dados.'}, 500
+
+    versao_var = obter_versao_var(conn)
+    erro = erro_modulo_comparacao(conn, modulo_selecionado)
+    if erro:
+        return {'erro': erro}, 400
+    chave = chave_cache('comparar', hashlib.sha256(conteudo_arquivo).hexdigest(), modulo=modulo_selecionado, versao_var=versao_var, top_n=top_n, score_minimo=score_minimo)
+    with medir('comparar_cache'):
+        resposta_em_cache = ler_cache_resultado(chave, 'comparar')
+    # Se a análise apontada pelo cache já expirou, a comparação é refeita.
+    if resposta_em_cache is not None and resposta_em_cache.get('analise_id') and obter_analise(conn, resposta_em_cache['analise_id']):
+        primeira_pagina = ler_pagina_analise(conn, resposta_em_cache['analise_id'], 1, TAMANHO_PAGINA_ANALISE)['resultados']
+        return montar_resposta_analise(resposta_em_cache, primeira_pagina, cache=True), 200
 
-    if 'arquivo_analise' not in request.files: return jsonify({'erro': 'Nenhum arquivo de análise enviado.'}), 400
-    
     try:
-        arquivo_usuario = request.files['arquivo_analise']
-        modulo_selecionado = request.form.get('modulo')
-        df_usuario = pd.read_excel(arquivo_usuario, usecols=[0])
+        progresso('Lendo planilha')
+        with medir('comparar_leitura_excel'):
+            df_usuario = pd.read_excel(io.BytesIO(conteudo_arquivo), usecols=[0])
         if df_usuario.empty or df_usuario.columns[0].lower().strip() not in ['funcionalidade', 'funcionalidades']:
-            return jsonify({'erro': f"Arquivo de análise inválido! O cabeçalho da primeira coluna ('{df_usuario.columns[0]}') deve ser 'Funcionalidade'."}), 400
-        
-        normalize = lambda s: str(s).lower().strip()
-        lista_func_usuario = [normalize(func) for func in df_usuario.iloc[:, 0].dropna()]
-        if not lista_func_usuario: return jsonify({'mensagem': 'Nenhuma funcionalidade para analisar na planilha enviada.'})
-        
-        conn = get_db_connection()
-        df_var = pd.read_sql_query('SELECT "ID Funcionalidade", "Funcionalidade" FROM dados_var WHERE "Módulo" = ?', conn, params=(modulo_selecionado,))
-        conn.close()
+            return {'erro': f"Arquivo de análise inválido! O cabeçalho da primeira coluna ('{df_usuario.columns[0]}') deve ser 'Funcionalidade'."}, 400
         
-        df_var['Funcionalidade_norm'] = df_var['Funcionalidade'].apply(normalize)
-        func_var_map = {row['Funcionalidade_norm']: {'id': row['ID Funcionalidade'], 'nome_original': row['Funcionalidade']} for _, row in df_var.iterrows()}
-        lista_func_var_norm = df_var['Funcionalidade_norm'].tolist()
+        lista_func_usuario = [normalizar_funcionalidade(func) for func in df_usuario.iloc[:, 0].dropna()]
+        if not lista_func_usuario: return {'mensagem': 'Nenhuma funcionalidade para analisar na planilha enviada.'}, 200
+        contar('validador_linhas_processadas_total', len(lista_func_usuario), operacao='comparar')
+
+        ranking_modulos = None
+        if modulo_selecionado == MODULO_AUTOMATICO:
+            progresso('Detectando módulo')
+            with medir('comparar_deteccao_modulo'):
+                ranking_modulos = detectar_modulo(conn, versao_var, lista_func_usuario)
+            if not ranking_modulos:
+                return {'erro': 'A Planilha VAR ativa não tem módulos para detectar.'}, 400
+            modulo_selecionado = ranking_modulos[0]['Módulo']
+
+        progresso('Buscando correspondências exatas')
+        with medir('comparar_exatos_sqlite'):
+            exatos = buscar_exatos_var(conn, versao_var, modulo_selecionado, lista_func_usuario)
     except Exception as e:
-        return jsonify({'erro': 'Falha interna no servidor ao processar os arquivos.'}), 500
+        return {'erro': 'Falha interna no servidor ao processar os arquivos.'}, 500
 
     resultados_finais = []
+    pendentes = []
     for idx, func_usuario_norm in enumerate(lista_func_usuario):
-        item = {'id': idx, 'Funcionalidade Analisada': func_usuario_norm, 'Status': 'Divergente', 'ID Encontrado': '', 'ID Sugerido': '', 'Sugestão Similar (VAR)': '', 'Similaridade (%)': 0.0}
-        if func_usuario_norm in func_var_map:
-            match = func_var_map[func_usuario_norm]
-            item.update({'Status': 'Encontrado', 'ID Encontrado': str(match['id']), 'Sugestão Similar (VAR)': match['nome_original'], 'Similaridade (%)': 100.0})
+        item = {'id': idx, 'Funcionalidade Analisada': func_usuario_norm, 'Status': 'Divergente', 'ID Encontrado': '', 'ID Sugerido': '', 'Sugestão Similar (VAR)': '', 'Similaridade (%)': 0.0, 'Caminho (VAR)': '', 'Sugestões': []}
+        if func_usuario_norm in exatos:
+            match = exatos[func_usuario_norm]
+            item.update({'Status': 'Encontrado', 'ID Encontrado': str(match['ID Funcionalidade']), 'Sugestão Similar (VAR)': match['Funcionalidade'], 'Similaridade (%)': 100.0})
         else:
-            best_match = process.extractOne(func_usuario_norm, lista_func_var_norm, scorer=fuzz.WRatio, score_cutoff=80)
-            if best_match:
-                sugestao_norm, score, _ = best_match
-                match = func_var_map[sugestao_norm]
-                item.update({'Status': 'Divergente com Sugestão', 'ID Sugerido': str(match['id']), 'Sugestão Similar (VAR)': match['nome_original'], 'Similaridade (%)': round(score, 2)})
+            pendentes.append(item)
         resultados_finais.append(item)
+
+    total_itens = len(resultados_finais)
+    processados = [total_itens - len(pendentes)]
+    def avancar(quantidade):
+        processados[0] += quantidade
+        progresso('Comparando funcionalidades', processados[0], total_itens)
+    avancar(0)
+
+    try:
+        if pendentes:
+            progresso('Carregando catálogo VAR')
+            with medir('comparar_catalogo'):
+                catalogo = obter_catalogo_var(conn, modulo_selecionado, versao_var)
+            indice = catalogo['indice']
+            escopos = definir_escopos(lista_func_usuario, {item['id'] for item in resultados_finais if item['Status'] == 'Encontrado'}, indice)
+            with medir('comparar_fuzzy'):
+                sugestoes_por_item = sugerir_por_hierarquia(
+                    [item['Funcionalidade Analisada'] for item in pendentes], [escopos[item['id']] for item in pendentes], catalogo, top_n, score_minimo, avancar,
+                    buscar_candidatos=lambda consulta: buscar_candidatos_fts(conn, versao_var, modulo_selecionado, consulta),
+                )
+        else:
+            sugestoes_por_item = []
+    except Exception as e:
+        app.logger.error("Erro na busca de sugestões", exc_info=True)
+        return {'erro': 'Falha interna no servidor ao processar os arquivos.'}, 500
+
+    for item, sugestoes in zip(pendentes, sugestoes_por_item):
+        item['Sugestões'] = [
+            {'ID': str(catalogo['ids'][i]), 'Funcionalidade': catalogo['nomes_originais'][i], 'Caminho': indice['caminhos'][i], 'Similaridade (%)': round(score, 2)}
+            for i, score in sugestoes
+        ]
+        if item['Sugestões']:
+            melhor = item['Sugestões'][0]
+            item.update({'Status': 'Divergente com Sugestão', 'ID Sugerido': melhor['ID'], 'Sugestão Similar (VAR)': melhor['Funcionalidade'], 'Caminho (VAR)': melhor['Caminho'], 'Similaridade (%)': melhor['Similaridade (%)']})
     
     sort_order = {'Divergente com Sugestão': 0, 'Divergente': 1, 'Encontrado': 2}
-    resultados_finais.sort(key=lambda item: sort_order.get(item['Status'], 99))
+    with medir('comparar_ordenacao'):
+        resultados_finais.sort(key=lambda item: sort_order.get(item['Status'], 99))
     
     json_response = {}
-    divergentes_count = sum(1 for r in resultados_finais if r['Status'] != 'Encontrado')
+    contagem_status = {}
+    for item in resultados_finais:
+        contagem_status[item['Status']] = contagem_status.get(item['Status'], 0) + 1
+    divergentes_count = len(resultados_finais) - contagem_status.get('Encontrado', 0)
 
     if resultados_finais:
         if divergentes_count == 0:
@@ -299,46 +1599,111 @@ def comparar():
         else:
             json_response['mensagem_status'] = {"texto": f"Análise com ressalvas. Foram encontradas {divergentes_count} divergências que podem requerer atenção.", "tipo": "ressalva"}
 
-    json_response.update({'resultados': resultados_finais})
-    return jsonify(json_response)
+    if ranking_modulos is not None:
+        json_response.update({'modulo_detectado': modulo_selecionado, 'ranking_modulos': ranking_modulos})
+    json_response.update({'modulo': modulo_selecionado, 'total': len(resultados_finais), 'contagem_status': contagem_status})
+    with medir('comparar_gravacao_analise'):
+        json_response['analise_id'] = salvar_analise(modulo_selecionado, versao_var, resultados_finais, json_response)
+    with medir('comparar_gravacao_cache'):
+        gravar_cache_resultado(chave, 'comparar', json_response, versao_var)
+    return montar_resposta_analise(json_response, resultados_finais[:TAMANHO_PAGINA_ANALISE], cache=False), 200
+
+@app.route('/comparar', methods=['POST'])
+def comparar():
+    if 'arquivo_analise' not in request.files: return jsonify({'erro': 'Nenhum arquivo de análise enviado.'}), 400
+
+    try:
+        top_n = ler_parametro_int('top_n', TOP_N_SUGESTOES_PADRAO, 1, 20)
+        score_minimo = ler_parametro_int('score_minimo', SCORE_MINIMO_PADRAO, 0, 100)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+
+    modulo_selecionado = request.form.get('modulo')
+    conn = get_db_connection(somente_leitura=True)
+    # Antes de criar a tarefa; executar_comparacao confere de novo.
+    erro = erro_modulo_comparacao(conn, modulo_selecionado) if var_ativa_disponivel(conn) else None
+    if erro:
+        return jsonify({'erro': erro}), 400
+
+    conteudo_arquivo = request.files['arquivo_analise'].read()
+    if pedido_assincrono():
+        tarefa_id = criar_tarefa('comparar', _tarefa_comparar, conteudo_arquivo, modulo_selecionado, top_n, score_minimo)
+        return resposta_tarefa_criada(tarefa_id)
+
+    resposta, status_http = executar_comparacao(conteudo_arquivo, modulo_selecionado, top_n, score_minimo)
+    with medir('comparar_json'):
+        return jsonify(resposta), status_http
+
+def _tarefa_comparar(conteudo_arquivo, modulo_selecionado, top_n, score_minimo, progresso):
+    resposta, _ = executar_comparacao(conteudo_arquivo, modulo_selecionado, top_n, score_minimo, progresso)
+    return resposta
+
+@app.route('/analises/<analise_id>')
+def ler_analise(analise_id):
+    try:
+        pagina = ler_parametro_int('pagina', 1, 1, 1_000_000)
+        tamanho_pagina = ler_parametro_int('tamanho_pagina', TAMANHO_PAGINA_ANALISE, 1, TAMANHO_PAGINA_MAXIMO)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    status = [valor for valor in request.args.getlist('status') if valor]
+
+    conn = get_db_connection(somente_leitura=True)
+    analise = obter_analise(conn, analise_id)
+    if not analise:
+        return jsonify({'erro': 'Análise não encontrada ou expirada. Execute a comparação novamente.'}), 404
+    if request.args.get('formato') == 'ndjson':
+        return Response((linha + '\n' for linha in iterar_resultados_analise(analise_id, status)), mimetype='application/x-ndjson')
+    with medir('analise_pagina'):
+        resposta = {'analise_id': analise_id, 'modulo': analise['modulo'], 'total_analise': analise['total'], 'status': status,
+                    **ler_pagina_analise(conn, analise_id, pagina, tamanho_pagina, status)}
+    return jsonify(resposta)
 
 @app.route('/gerar_importacao', methods=['POST'])
 def gerar_importacao():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
+    analise_id = data.get('analise_id')
     resultados_analise = data.get('resultados')
     perfil_id = data.get('perfil_id')
     perfil_nome = data.get('perfil_nome')
+    formato = str(data.get('formato') or 'xlsx').lower()
 
-    if not all([resultados_analise, perfil_id, perfil_nome]):
+    if not (perfil_id and perfil_nome and (analise_id or resultados_analise)):
         return jsonify({"erro": "Dados insuficientes"}), 400
+    if formato not in ('xlsx', 'csv'):
+        return jsonify({"erro": "Formato inválido. Use 'xlsx' ou 'csv'."}), 400
 
-    try:
-        df_analise = pd.DataFrame(resultados_analise)
-        
-        get_final_id = lambda row: (str(row.get('ID Encontrado', '')).strip() or str(row.get('ID Sugerido', '')).strip()) or '❗ Não encontrado'
-        def get_final_funcionalidade(row):
-            sugestao_var = str(row.get('Sugestão Similar (VAR)', '')).strip()
-            return sugestao_var if row.get('Status') in ['Encontrado', 'Divergente com Sugestão'] and sugestao_var else row.get('Funcionalidade Analisada', '')
-
-        df_importacao = pd.DataFrame()
-        df_importacao['funcionalidade'] = df_analise.apply(get_final_funcionalidade, axis=1)
-        df_importacao['funcionalidade id'] = df_analise.apply(get_final_id, axis=1)
-        df_importacao['id'] = perfil_id
-        df_importacao['perfil'] = perfil_nome
-        df_importacao = df_importacao[['id', 'perfil', 'funcionalidade id', 'funcionalidade']]
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df_importacao.to_excel(writer, index=False, sheet_name='Importa VAR')
-        output.seek(0)
-        
-        data_formatada = datetime.now().strftime("%Y-%m-%d_%H-%M")
-        nome_arquivo = f"Importar_VAR_{secure_filename(perfil_nome)}_{data_formatada}.xlsx"
+    if analise_id:
+        analise = obter_analise(get_db_connection(somente_leitura=True), analise_id)
+        if not analise:
+            return jsonify({"erro": "Análise não encontrada ou expirada. Execute a comparação novamente."}), 404
+        total_linhas = analise['total']
+        blocos = (montar_colunas_importacao(bloco, perfil_id, perfil_nome) for bloco in ler_blocos_analise(analise_id))
+    else:
+        # Formato antigo: o próprio resultado vem no corpo da requisição.
+        total_linhas = len(resultados_analise)
+        blocos = iter([montar_colunas_importacao(pd.DataFrame(resultados_analise), perfil_id, perfil_nome)])
+    contar('validador_linhas_processadas_total', total_linhas, operacao='gerar_importacao')
+
+    data_formatada = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    nome_arquivo = f"Importar_VAR_{secure_filename(perfil_nome)}_{data_formatada}.{formato}"
+    if formato == 'csv':
+        return Response(gerar_importacao_csv(blocos), mimetype='text/csv; charset=utf-8',
+                        headers={'Content-Disposition': f'attachment; filename={nome_arquivo}'})
 
-        return send_file(output, as_attachment=True, download_name=nome_arquivo, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    descritor, caminho = tempfile.mkstemp(suffix='.xlsx', dir=app.config['OUTPUT_FOLDER'])
+    os.close(descritor)
+    try:
+        with medir('importacao_escrita_excel'):
+            escrever_importacao_xlsx(blocos, caminho)
     except Exception as e:
+        os.remove(caminho)
         app.logger.error("Erro ao gerar planilha de importação", exc_info=True)
         return jsonify({"erro": "Ocorreu um erro interno ao gerar o arquivo."}), 500
+    # send_file com caminho não dispara call_on_close; com o gerador, o temporário sai ao fechar a resposta.
+    resposta = Response(ler_em_blocos(caminho), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                        headers={'Content-Disposition': f'attachment; filename={nome_arquivo}', 'Content-Length': str(os.path.getsize(caminho))})
+    resposta.call_on_close(lambda: os.remove(caminho))
+    return resposta
 
 # --- ROTAS DO ANALISADOR DE RISCOS SoD (Atualizada) ---
 @app.route('/sod_analyzer', methods=['GET', 'POST'])
@@ -347,27 +1712,142 @@ def sod_analyzer():
         if 'file' not in request.files:
             flash('Nenhum arquivo enviado.', 'danger')
             return redirect(url_for('sod_analyzer'))
-        file = request.files['file']
-        if file.filename == '':
+        arquivos = [arquivo for arquivo in request.files.getlist('file') if arquivo.filename]
+        if not arquivos:
             flash('Nenhum arquivo selecionado.', 'danger')
             return redirect(url_for('sod_analyzer'))
-        if file and allowed_file(file.filename):
+        cenario = request.form.get('analysis_type', 'manutencao')
+        matriz_id = obter_matriz_risco_ativa(get_db_connection())
+
+        if len(arquivos) > 1 or arquivos[0].filename.lower().endswith('.zip'):
+            try:
+                pasta_temporaria, extraidos = preparar_lote_sod(arquivos)
+            except zipfile.BadZipFile:
+                flash('O arquivo .zip enviado está corrompido ou não é um .zip válido.', 'danger')
+                return redirect(url_for('sod_analyzer'))
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('sod_analyzer'))
+            if not extraidos:
+                shutil.rmtree(pasta_temporaria, ignore_errors=True)
+                flash('Nenhuma planilha .xlsx ou .xls encontrada nos arquivos enviados.', 'danger')
+                return redirect(url_for('sod_analyzer'))
+            if pedido_assincrono():
+                return resposta_tarefa_criada(criar_tarefa('sod_analyzer', _tarefa_lote_sod, pasta_temporaria, extraidos, cenario, matriz_id))
+            lote = processar_lote_sod(pasta_temporaria, extraidos, cenario, matriz_id)
+            with medir('sod_render'):
+                return render_template('sod_analyzer/index.html', lote=lote, has_result=True, active_app='sod_analyzer')
+
+        file = arquivos[0]
+        if allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            cenario = request.form.get('analysis_type', 'manutencao')
-            resultado_analise = analisar_riscos_excel(filepath, cenario)
-            
-            os.remove(filepath)
+            resultado_analise = None
+            if not pedido_assincrono():
+                resultado_analise = ler_cache_resultado(chave_cache_sod(calcular_sha256(file.stream), cenario, matriz_id), 'sod')
+            if resultado_analise is not None:
+                resultado_analise['cache'] = True
+            else:
+                filepath, sha256_arquivo = salvar_upload_temporario(file.stream, filename, app.config['UPLOAD_FOLDER'])
+                if pedido_assincrono():
+                    return resposta_tarefa_criada(criar_tarefa('sod_analyzer', _tarefa_arquivo_sod, filepath, sha256_arquivo, filename, cenario, matriz_id))
+                try:
+                    resultado_analise = analisar_sod_com_cache(filepath, sha256_arquivo, cenario, matriz_id, consultar_cache=False)
+                finally:
+                    os.remove(filepath)
             resultado_analise['nome_arquivo'] = filename
             
-            return render_template('sod_analyzer/index.html', resultado=resultado_analise, has_result=True, active_app='sod_analyzer')
+            with medir('sod_render'):
+                return render_template('sod_analyzer/index.html', resultado=resultado_analise, has_result=True, active_app='sod_analyzer')
         else:
-            flash('Tipo de arquivo não permitido. Por favor, envie um arquivo .xlsx ou .xls.', 'danger')
+            flash('Tipo de arquivo não permitido. Por favor, envie um arquivo .xlsx, .xls ou .zip.', 'danger')
             return redirect(url_for('sod_analyzer'))
     
-    return render_template('sod_analyzer/index.html', has_result=False, active_app='sod_analyzer')
+    historico = listar_historico_matrizes(get_db_connection(somente_leitura=True))
+    return render_template('sod_analyzer/index.html', has_result=False, historico_matrizes=historico['itens'], historico_matrizes_paginas=historico['total_paginas'], active_app='sod_analyzer')
+
+def _tarefa_arquivo_sod(filepath, sha256_arquivo, filename, cenario, matriz_id, progresso):
+    try:
+        progresso('Analisando arquivo')
+        resultado_analise = analisar_sod_com_cache(filepath, sha256_arquivo, cenario, matriz_id)
+    finally:
+        os.remove(filepath)
+    resultado_analise['nome_arquivo'] = filename
+    return {'resultado': resultado_analise}
+
+def _tarefa_lote_sod(pasta_temporaria, extraidos, cenario, matriz_id, progresso):
+    return {'lote': processar_lote_sod(pasta_temporaria, extraidos, cenario, matriz_id, progresso)}
+
+@app.route('/sod_analyzer/tarefa/<tarefa_id>')
+def resultado_tarefa_sod(tarefa_id):
+    tarefa = obter_tarefa(tarefa_id)
+    if not tarefa or tarefa['tipo'] != 'sod_analyzer':
+        flash('Tarefa não encontrada.', 'danger')
+        return redirect(url_for('sod_analyzer'))
+    if tarefa['status'] != 'Concluída':
+        return redirect(url_for('status_tarefa', tarefa_id=tarefa_id))
+    resultado = json.loads(tarefa['resultado'])
+    return render_template('sod_analyzer/index.html', resultado=resultado.get('resultado'), lote=resultado.get('lote'), has_result=True, active_app='sod_analyzer')
+
+@app.route('/sod_analyzer/relatorio/<nome_relatorio>')
+def baixar_relatorio_sod(nome_relatorio):
+    # Só os relatórios de lote: o resto de outputs/ (perfis, exportações) não sai por aqui.
+    if not PADRAO_RELATORIO_SOD.fullmatch(nome_relatorio):
+        abort(404)
+    return send_from_directory(app.config['RELATORIOS_SOD_FOLDER'], nome_relatorio, as_attachment=True)
+
+@app.route('/sod_analyzer/matriz', methods=['POST'])
+def upload_matriz_riscos():
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('Nenhum arquivo selecionado.', 'danger')
+    elif not allowed_file(file.filename):
+        flash('Tipo de arquivo não permitido. Por favor, envie um arquivo .xlsx ou .xls.', 'danger')
+    else:
+        original_filename = secure_filename(file.filename)
+        descritor, filepath = tempfile.mkstemp(suffix=os.path.splitext(original_filename)[1], dir=app.config['UPLOAD_FOLDER'])
+        os.close(descritor)
+        try:
+            file.save(filepath)
+            df_matriz = ler_matriz_riscos(filepath)
+            if df_matriz.empty:
+                flash('Nenhum risco encontrado na matriz enviada.', 'danger')
+            else:
+                conn = get_db_connection()
+                with conn:
+                    matriz_id = carregar_matriz_riscos(conn, df_matriz, original_filename)
+                    ativar_matriz_riscos(conn, matriz_id)
+                flash(f"Matriz de riscos '{original_filename}' carregada e ativada com {len(df_matriz)} riscos.", 'success')
+        except Exception as e:
+            app.logger.error("Falha ao carregar a matriz de riscos SoD", exc_info=True)
+            flash(f"Erro ao ler a matriz de riscos: {e}", 'danger')
+        finally:
+            os.remove(filepath)
+    return redirect(url_for('sod_analyzer'))
+
+@app.route('/sod_analyzer/matriz/ativar/<int:matriz_id>')
+def ativar_matriz(matriz_id):
+    conn = get_db_connection()
+    matriz = conn.execute('SELECT * FROM matrizes_risco_historico WHERE id = ? AND status IN ("Válido", "Arquivado")', (matriz_id,)).fetchone()
+    if matriz:
+        ativar_matriz_riscos(conn, matriz_id)
+        conn.commit()
+        flash(f"Matriz de riscos '{matriz['nome_arquivo_original']}' ativada com sucesso!", 'success')
+    else:
+        flash("Matriz para ativação não encontrada ou inválida.", 'danger')
+    return redirect(url_for('sod_analyzer'))
+
+@app.route('/sod_analyzer/matriz/historico')
+def historico_matrizes():
+    try:
+        pagina = ler_parametro_int('pagina', 1, 1, 1_000_000)
+        tamanho_pagina = ler_parametro_int('tamanho_pagina', HISTORICO_POR_PAGINA, 1, 500)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    historico = listar_historico_matrizes(get_db_connection(somente_leitura=True), pagina, tamanho_pagina)
+    for item in historico['itens']:
+        if item['status'] in ('Válido', 'Arquivado'):
+            item['url_ativar'] = url_for('ativar_matriz', matriz_id=item['id'])
+    return jsonify(historico)
 
 
 if __name__ == '__main__':
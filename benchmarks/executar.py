@@ -0,0 +1,289 @@
+"""Benchmarks das rotas principais pelo cliente de testes do Flask.
+
+Gera VAR, perfis e exports SoD sintéticos (gerar_dados.py), aponta o app para um banco e
+pastas temporárias (VALIDADOR_DATABASE / VALIDADOR_UPLOAD_FOLDER / VALIDADOR_OUTPUT_FOLDER)
+e mede upload_var, ativar_var, comparar (com e sem cache de resultado, e com detecção de
+módulo), gerar_importacao (xlsx e CSV) e o analisador SoD nos dois cenários.
+
+Para cada operação registra latência (média, p50, p95), vazão em linhas por segundo (pela
+mediana) e o pico de memória Python (tracemalloc, numa execução extra, fora das medições de
+tempo). Mede também a qualidade das sugestões: a fração das linhas do perfil com erro (no nome
+ou no código entre colchetes) cuja primeira sugestão é o nome original da VAR. O resultado pode
+ser gravado como baseline e comparado nas próximas execuções; uma operação cujo p50 piora mais
+que a tolerância, ou um acerto que cai mais que a tolerância de qualidade, é reportado como
+regressão (código de saída 1).
+Tempos dependem da máquina: a baseline versionada serve de referência para os parâmetros
+padrão; para acompanhar regressões num servidor, grave uma baseline nele.
+
+    python benchmarks/executar.py
+    python benchmarks/executar.py --linhas-var 1000 100000 500000 --repeticoes 3
+    python benchmarks/executar.py --salvar-baseline
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import gerar_dados
+
+BASELINE_PADRAO = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+
+def percentil(valores, fracao):
+    ordenados = sorted(valores)
+    posicao = (len(ordenados) - 1) * fracao
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicao - inferior)
+
+
+def medir_operacao(funcao, repeticoes, linhas):
+    """Chama funcao(i) `repeticoes` vezes cronometrando, e mais uma vez sob tracemalloc para o pico de memória."""
+    duracoes = []
+    for indice in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao(indice)
+        duracoes.append(time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    try:
+        funcao(repeticoes)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50 = percentil(duracoes, 0.50)
+    return {
+        'repeticoes': repeticoes,
+        'linhas': linhas,
+        'media_s': round(statistics.mean(duracoes), 4),
+        'p50_s': round(p50, 4),
+        'p95_s': round(percentil(duracoes, 0.95), 4),
+        'linhas_por_s': round(linhas / p50, 1) if p50 > 0 else None,
+        'pico_memoria_mb': round(pico / 1024 / 1024, 2),
+    }
+
+
+def verificar(resposta, *status_esperados):
+    if resposta.status_code not in status_esperados:
+        raise RuntimeError(f'{resposta.request.path} respondeu {resposta.status_code}: {resposta.get_data(as_text=True)[:300]}')
+    return resposta
+
+
+def qualidade_sugestoes(resultados_analise, linhas_perfil, modulo_app):
+    """Acerto da primeira sugestão nas linhas com erro, no geral e só nas que têm o código errado."""
+    sugestao_por_linha = {item['Funcionalidade Analisada']: item['Sugestão Similar (VAR)'] for item in resultados_analise}
+    acertos = {'geral': [], 'codigo': []}
+    for funcionalidade, origem in linhas_perfil:
+        if origem is None or funcionalidade == origem:
+            continue
+        acerto = sugestao_por_linha.get(modulo_app.normalizar_funcionalidade(funcionalidade)) == origem
+        acertos['geral'].append(acerto)
+        if modulo_app.extrair_codigo_var(funcionalidade) != modulo_app.extrair_codigo_var(origem):
+            acertos['codigo'].append(acerto)
+    return {
+        'linhas_com_erro': len(acertos['geral']),
+        'acerto_top1': round(sum(acertos['geral']) / len(acertos['geral']), 4) if acertos['geral'] else None,
+        'linhas_com_erro_codigo': len(acertos['codigo']),
+        'acerto_top1_codigo': round(sum(acertos['codigo']) / len(acertos['codigo']), 4) if acertos['codigo'] else None,
+    }
+
+
+def executar_cenario(modulo_app, pasta, linhas_var, args):
+    """Roda todas as operações contra uma VAR de `linhas_var` linhas num banco novo em `pasta`.
+
+    Retorna (medidas por operação, qualidade das sugestões do primeiro perfil).
+    """
+    app = modulo_app.app
+    app.config.update(
+        DATABASE=os.path.join(pasta, 'benchmark.db'),
+        UPLOAD_FOLDER=os.path.join(pasta, 'uploads'),
+        OUTPUT_FOLDER=os.path.join(pasta, 'outputs'),
+    )
+    modulo_app.setup()
+    modulo_app.trocar_cache_catalogo(None)
+    cliente = app.test_client()
+    resultados = {}
+
+    caminho_var = os.path.join(pasta, 'var.xlsx')
+    nomes_por_modulo = gerar_dados.gerar_var(caminho_var, linhas_var, semente=args.semente)
+    with open(caminho_var, 'rb') as arquivo:
+        conteudo_var = arquivo.read()
+    modulo_perfil = gerar_dados.MODULOS[1]
+
+    def upload_var(indice):
+        verificar(cliente.post('/upload_var', data={'file': (io.BytesIO(conteudo_var), f'var_{indice}.xlsx')}, content_type='multipart/form-data'), 302)
+    resultados['upload_var'] = medir_operacao(upload_var, args.repeticoes, linhas_var)
+
+    conn = modulo_app.get_db_connection()
+    # Só os uploads que ainda têm var_<id> (limpar_tabelas_var): os mais antigos seriam relidos do Excel.
+    uploads = [row['id'] for row in conn.execute('SELECT id FROM uploads_historico ORDER BY id DESC LIMIT ?', (modulo_app.VAR_TABELAS_MANTIDAS,))]
+    def ativar_var(indice):
+        # Alterna entre as versões enviadas: a ativa não pode ser reativada.
+        verificar(cliente.get(f'/ativar_var/{uploads[indice % len(uploads)]}'), 302)
+    resultados['ativar_var'] = medir_operacao(ativar_var, args.repeticoes, linhas_var)
+
+    perfis = []
+    linhas_perfis = []
+    for indice in range(args.repeticoes + 1):
+        caminho_perfil = os.path.join(pasta, f'perfil_{indice}.xlsx')
+        linhas_perfis.append(gerar_dados.gerar_perfil(caminho_perfil, nomes_por_modulo[modulo_perfil], args.linhas_perfil, args.taxa_erros,
+                                                      semente=args.semente + indice, taxa_erros_codigo=args.taxa_erros_codigo))
+        with open(caminho_perfil, 'rb') as arquivo:
+            perfis.append(arquivo.read())
+    linhas_perfil = min(args.linhas_perfil, len(nomes_por_modulo[modulo_perfil]))
+    ultima_comparacao = {}
+
+    def comparar_com(modulo, perfil):
+        resposta = verificar(cliente.post('/comparar', data={'modulo': modulo, 'arquivo_analise': (io.BytesIO(perfil), 'perfil.xlsx')}, content_type='multipart/form-data'), 200)
+        ultima_comparacao.update(resposta.get_json())
+
+    # Cada repetição usa um perfil diferente: o cache de resultados não pode responder.
+    resultados['comparar'] = medir_operacao(lambda indice: comparar_com(modulo_perfil, perfis[indice]), args.repeticoes, linhas_perfil)
+    resultados['comparar_cache'] = medir_operacao(lambda indice: comparar_com(modulo_perfil, perfis[0]), args.repeticoes, linhas_perfil)
+    resultados_perfil = verificar(cliente.get(f"/analises/{ultima_comparacao['analise_id']}?formato=ndjson"), 200).get_data(as_text=True)
+    qualidade = qualidade_sugestoes([json.loads(linha) for linha in resultados_perfil.splitlines()], linhas_perfis[0], modulo_app)
+    resultados['comparar_auto'] = medir_operacao(lambda indice: comparar_com(modulo_app.MODULO_AUTOMATICO, perfis[indice]), args.repeticoes, linhas_perfil)
+
+    analise_id = ultima_comparacao['analise_id']
+    def gerar_importacao(indice, formato):
+        # get_data() consome o corpo inteiro: o CSV é gerado em streaming enquanto é lido.
+        verificar(cliente.post('/gerar_importacao', json={'analise_id': analise_id, 'perfil_id': str(indice), 'perfil_nome': 'PERFIL_BENCHMARK', 'formato': formato}), 200).get_data()
+    resultados['gerar_importacao'] = medir_operacao(lambda indice: gerar_importacao(indice, 'xlsx'), args.repeticoes, ultima_comparacao['total'])
+    resultados['gerar_importacao_csv'] = medir_operacao(lambda indice: gerar_importacao(indice, 'csv'), args.repeticoes, ultima_comparacao['total'])
+
+    exports_sod = []
+    for indice in range(args.repeticoes + 1):
+        caminho_sod = os.path.join(pasta, f'sod_{indice}.xlsx')
+        gerar_dados.gerar_export_sod(caminho_sod, args.linhas_sod, args.riscos_sod, perfil=f'PERFIL_{indice}', semente=args.semente + indice)
+        with open(caminho_sod, 'rb') as arquivo:
+            exports_sod.append(arquivo.read())
+    for cenario in ('criacao', 'manutencao'):
+        def analisar(indice, cenario=cenario):
+            resposta = verificar(cliente.post('/sod_analyzer', data={'analysis_type': cenario, 'file': (io.BytesIO(exports_sod[indice]), 'export.xlsx')}, content_type='multipart/form-data'), 200)
+            if b'Erro ao' in resposta.data:
+                raise RuntimeError(f'Análise SoD ({cenario}) falhou no export {indice}')
+        resultados[f'sod_{cenario}'] = medir_operacao(analisar, args.repeticoes, args.linhas_sod + args.riscos_sod)
+
+    return resultados, qualidade
+
+
+def comparar_com_baseline(atual, baseline, tolerancia, folga_minima):
+    """Lista (cenário, operação, p50 baseline, p50 atual, variação, regressão) das operações medidas nos dois.
+
+    Só é regressão se a piora passar da tolerância relativa e também de `folga_minima` segundos,
+    para que o ruído de operações de poucos milissegundos não dispare alarmes.
+    """
+    comparacoes = []
+    for cenario, operacoes in atual['resultados'].items():
+        for operacao, medida in operacoes.items():
+            referencia = baseline.get('resultados', {}).get(cenario, {}).get(operacao)
+            if not referencia or not referencia.get('p50_s'):
+                continue
+            variacao = medida['p50_s'] / referencia['p50_s'] - 1
+            regressao = variacao > tolerancia and medida['p50_s'] - referencia['p50_s'] > folga_minima
+            comparacoes.append((cenario, operacao, referencia['p50_s'], medida['p50_s'], variacao, regressao))
+    return comparacoes
+
+
+def comparar_qualidade_com_baseline(atual, baseline, tolerancia):
+    """Lista (cenário, métrica, acerto baseline, acerto atual, regressão); é regressão se o acerto cair mais que `tolerancia`."""
+    comparacoes = []
+    for cenario, metricas in atual['qualidade'].items():
+        referencia = baseline.get('qualidade', {}).get(cenario, {})
+        for metrica in ('acerto_top1', 'acerto_top1_codigo'):
+            if referencia.get(metrica) is None or metricas.get(metrica) is None:
+                continue
+            comparacoes.append((cenario, metrica, referencia[metrica], metricas[metrica], referencia[metrica] - metricas[metrica] > tolerancia))
+    return comparacoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--linhas-var', type=int, nargs='+', default=[1_000, 10_000], help='tamanhos de VAR (um cenário por tamanho, 1k a 500k)')
+    parser.add_argument('--linhas-perfil', type=int, default=500)
+    parser.add_argument('--taxa-erros', type=float, default=0.2, help='fração das linhas do perfil com erro de digitação')
+    parser.add_argument('--taxa-erros-codigo', type=float, default=0.1, help='fração das linhas do perfil com o código entre colchetes errado')
+    parser.add_argument('--linhas-sod', type=int, default=300, help='linhas do relatório do ticket no export SoD')
+    parser.add_argument('--riscos-sod', type=int, default=600)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_PADRAO)
+    parser.add_argument('--salvar-baseline', action='store_true', help='grava o resultado como nova baseline')
+    parser.add_argument('--tolerancia', type=float, default=0.25, help='piora máxima aceita no p50 antes de apontar regressão')
+    parser.add_argument('--folga-minima', type=float, default=0.05, help='piora absoluta mínima (s) no p50 para apontar regressão')
+    parser.add_argument('--tolerancia-qualidade', type=float, default=0.02, help='queda máxima aceita no acerto das sugestões')
+    parser.add_argument('--saida', help='grava o resultado completo em JSON')
+    args = parser.parse_args()
+
+    pasta_raiz = tempfile.mkdtemp(prefix='benchmark_validador_')
+    # O app cria o banco e as pastas já no import: aponta tudo para a pasta temporária antes.
+    os.environ.update(
+        VALIDADOR_DATABASE=os.path.join(pasta_raiz, 'import.db'),
+        VALIDADOR_UPLOAD_FOLDER=os.path.join(pasta_raiz, 'uploads'),
+        VALIDADOR_OUTPUT_FOLDER=os.path.join(pasta_raiz, 'outputs'),
+    )
+    import app as modulo_app
+    modulo_app.app.logger.disabled = True
+
+    resultado = {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'ambiente': {'python': platform.python_version(), 'plataforma': platform.platform(), 'cpus': os.cpu_count()},
+        'parametros': {chave: valor for chave, valor in vars(args).items() if chave not in ('baseline', 'salvar_baseline', 'saida')},
+        'resultados': {},
+        'qualidade': {},
+    }
+    try:
+        for linhas_var in args.linhas_var:
+            pasta = os.path.join(pasta_raiz, f'var_{linhas_var}')
+            os.makedirs(pasta)
+            print(f'== VAR com {linhas_var} linhas', flush=True)
+            operacoes, qualidade = executar_cenario(modulo_app, pasta, linhas_var, args)
+            resultado['resultados'][f'var_{linhas_var}'] = operacoes
+            resultado['qualidade'][f'var_{linhas_var}'] = qualidade
+            for operacao, medida in operacoes.items():
+                print(f"  {operacao:<20} p50 {medida['p50_s']:>8.3f}s  p95 {medida['p95_s']:>8.3f}s  {medida['linhas_por_s'] or 0:>12,.0f} linhas/s  pico {medida['pico_memoria_mb']:>8.1f} MB", flush=True)
+            print(f"  {'sugestões':<20} acerto {qualidade['acerto_top1'] or 0:.1%} em {qualidade['linhas_com_erro']} linhas com erro, "
+                  f"{qualidade['acerto_top1_codigo'] or 0:.1%} em {qualidade['linhas_com_erro_codigo']} com o código errado", flush=True)
+    finally:
+        shutil.rmtree(pasta_raiz, ignore_errors=True)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+
+    if args.salvar_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+        print(f'Baseline gravada em {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('Sem baseline para comparar (use --salvar-baseline).')
+        return 0
+    with open(args.baseline, encoding='utf-8') as arquivo:
+        baseline = json.load(arquivo)
+    comparacoes = comparar_com_baseline(resultado, baseline, args.tolerancia, args.folga_minima)
+    print(f"== Comparação com a baseline de {baseline.get('data')} (tolerância {args.tolerancia:.0%})")
+    for cenario, operacao, referencia, atual, variacao, regressao in comparacoes:
+        print(f"  {cenario:<12} {operacao:<20} {referencia:>8.3f}s -> {atual:>8.3f}s  {variacao:+7.1%}{'  REGRESSÃO' if regressao else ''}")
+    comparacoes_qualidade = comparar_qualidade_com_baseline(resultado, baseline, args.tolerancia_qualidade)
+    for cenario, metrica, referencia, atual, regressao in comparacoes_qualidade:
+        print(f"  {cenario:<12} {metrica:<20} {referencia:>8.1%} -> {atual:>8.1%}{'  REGRESSÃO' if regressao else ''}")
+    return 1 if any(regressao for *_, regressao in comparacoes + comparacoes_qualidade) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
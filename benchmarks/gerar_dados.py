@@ -0,0 +1,210 @@
+"""Geradores de planilhas sintéticas para os benchmarks.
+
+Tudo é determinístico pela `semente`, para que duas execuções meçam exatamente os mesmos dados.
+
+    python benchmarks/gerar_dados.py var --linhas 100000 var.xlsx
+    python benchmarks/gerar_dados.py perfil --var var.xlsx --linhas 800 --taxa-erros 0.3 --taxa-erros-codigo 0.1 perfil.xlsx
+    python benchmarks/gerar_dados.py sod --linhas 200 --riscos 400 export_sod.xlsx
+"""
+import argparse
+import random
+
+import xlsxwriter
+
+MODULOS = [
+    'TOTVS Educacional', 'TOTVS Folha de Pagamento', 'TOTVS Gestão Contábil',
+    'TOTVS Gestão de Estoque, Compras e Faturamento', 'TOTVS Gestão de Pessoas',
+    'TOTVS Gestão Financeira', 'TOTVS Gestão Fiscal', 'TOTVS Gestão Patrimonial',
+    'TOTVS Inteligência de Negócios'
+]
+PALAVRAS = [
+    'cadastro', 'consulta', 'relatório', 'movimento', 'lançamento', 'processo', 'funcionário', 'folha',
+    'férias', 'rescisão', 'contrato', 'cálculo', 'parâmetros', 'tabela', 'alteração', 'exclusão',
+    'inclusão', 'aprovação', 'integração', 'contábil', 'fiscal', 'estoque', 'compras', 'faturamento',
+    'financeiro', 'título', 'baixa', 'banco', 'conciliação', 'patrimônio', 'depreciação', 'aluno',
+    'matrícula', 'turma', 'disciplina', 'avaliação', 'seletivo', 'benefício', 'encargos', 'provisão',
+]
+STATUS_RELATORIO = ['Adicionado', 'Mantido', 'Mantido', 'Removido']
+CRITICIDADES = ['Alta', 'Média', 'Baixa', 'Muito Alta']
+
+# Mesmas colunas mescladas que o app espera (GRUPOS_RELATORIO_SOD / GRUPOS_RISCOS_SOD).
+LARGURAS_RELATORIO = [2, 2, 4, 2]
+LARGURAS_RISCOS = [2, 4, 2, 2, 2, 2, 2, 2, 2, 2]
+
+
+def _nome_funcionalidade(rnd):
+    return ' '.join(rnd.sample(PALAVRAS, rnd.randint(2, 5)))
+
+
+def _codigos_hierarquicos(quantidade, rnd, profundidade_maxima=5):
+    """Sequência de códigos [01], [01.01], [01.01.01]... na ordem de uma árvore percorrida em pré-ordem."""
+    codigo = []
+    for _ in range(quantidade):
+        profundidade = rnd.randint(1, min(len(codigo) + 1, profundidade_maxima))
+        if profundidade > len(codigo):
+            codigo = codigo + [1]
+        else:
+            codigo = codigo[:profundidade]
+            codigo[-1] += 1
+        yield '.'.join(f'{parte:02d}' for parte in codigo)
+
+
+def gerar_var(caminho, linhas, modulos=MODULOS, semente=0):
+    """Planilha VAR (id, funcionalidade, modulo id, modulo) com nomes hierárquicos. Retorna {modulo: [nomes]}."""
+    rnd = random.Random(semente)
+    por_modulo = {modulo: linhas // len(modulos) + (1 if indice < linhas % len(modulos) else 0) for indice, modulo in enumerate(modulos)}
+    nomes = {}
+    workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True})
+    planilha = workbook.add_worksheet()
+    planilha.write_row(0, 0, ['id', 'funcionalidade', 'modulo id', 'modulo'])
+    linha = 1
+    for id_modulo, (modulo, quantidade) in enumerate(por_modulo.items(), start=1):
+        nomes[modulo] = []
+        for codigo in _codigos_hierarquicos(quantidade, rnd):
+            nome = f'[{codigo}] {_nome_funcionalidade(rnd)}'
+            nomes[modulo].append(nome)
+            planilha.write_row(linha, 0, [linha, nome, id_modulo, modulo])
+            linha += 1
+    workbook.close()
+    return nomes
+
+
+def aplicar_erro(texto, rnd):
+    """Um erro de digitação: troca, remove, duplica ou substitui um caractere fora do código."""
+    inicio = texto.find(']') + 2 if texto.startswith('[') else 0
+    if len(texto) - inicio < 4:
+        return texto
+    posicao = rnd.randrange(inicio, len(texto) - 1)
+    operacao = rnd.choice(['trocar', 'remover', 'duplicar', 'substituir'])
+    if operacao == 'trocar':
+        return texto[:posicao] + texto[posicao + 1] + texto[posicao] + texto[posicao + 2:]
+    if operacao == 'remover':
+        return texto[:posicao] + texto[posicao + 1:]
+    if operacao == 'duplicar':
+        return texto[:posicao] + texto[posicao] + texto[posicao:]
+    return texto[:posicao] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + texto[posicao + 1:]
+
+
+def aplicar_erro_codigo(texto, rnd):
+    """Um erro no código entre colchetes: renumera o último nível ou troca um dígito de qualquer nível."""
+    if not texto.startswith('[') or ']' not in texto:
+        return texto
+    fim = texto.index(']')
+    partes = texto[1:fim].split('.')
+    if rnd.choice(['renumerar', 'digito']) == 'renumerar':
+        partes[-1] = f'{int(partes[-1]) + rnd.randint(1, 9):02d}'
+    else:
+        nivel = rnd.randrange(len(partes))
+        digito = rnd.randrange(len(partes[nivel]))
+        partes[nivel] = partes[nivel][:digito] + str((int(partes[nivel][digito]) + rnd.randint(1, 9)) % 10) + partes[nivel][digito + 1:]
+    return '[' + '.'.join(partes) + texto[fim:]
+
+
+def gerar_perfil(caminho, nomes_var, linhas, taxa_erros=0.2, taxa_inexistentes=0.05, semente=0, taxa_erros_codigo=0.0):
+    """Planilha de perfil (cabeçalho "Funcionalidade") sorteada de `nomes_var`, mantendo a ordem da VAR.
+
+    `taxa_erros` das linhas recebe um erro de digitação e `taxa_inexistentes` vira um nome que não existe na VAR;
+    das que vêm da VAR, `taxa_erros_codigo` ainda recebe um erro no código. Retorna [(funcionalidade, nome de origem na VAR ou None)].
+    """
+    rnd = random.Random(semente)
+    posicoes = sorted(rnd.sample(range(len(nomes_var)), min(linhas, len(nomes_var))))
+    linhas_perfil = []
+    for posicao in posicoes:
+        sorteio = rnd.random()
+        if sorteio < taxa_inexistentes:
+            linhas_perfil.append((_nome_funcionalidade(rnd) + ' personalizado', None))
+            continue
+        funcionalidade = aplicar_erro(nomes_var[posicao], rnd) if sorteio < taxa_inexistentes + taxa_erros else nomes_var[posicao]
+        if taxa_erros_codigo and rnd.random() < taxa_erros_codigo:
+            funcionalidade = aplicar_erro_codigo(funcionalidade, rnd)
+        linhas_perfil.append((funcionalidade, nomes_var[posicao]))
+    workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True})
+    planilha = workbook.add_worksheet()
+    planilha.write(0, 0, 'Funcionalidade')
+    for linha, (funcionalidade, _) in enumerate(linhas_perfil, start=1):
+        planilha.write(linha, 0, funcionalidade)
+    workbook.close()
+    return linhas_perfil
+
+
+def _escrever_mesclado(planilha, linha, larguras, valores):
+    coluna = 0
+    for largura, valor in zip(larguras, valores):
+        if largura > 1:
+            planilha.merge_range(linha, coluna, linha, coluna + largura - 1, valor)
+        else:
+            planilha.write(linha, coluna, valor)
+        coluna += largura
+
+
+def gerar_export_sod(caminho, linhas_relatorio, riscos, perfil='PERFIL_BENCHMARK', linhas_rodape=20, semente=0):
+    """Export do GRC com as duas tabelas (relatório do ticket e riscos SoD) em colunas mescladas, e um rodapé."""
+    rnd = random.Random(semente)
+    funcionalidades = [f'FUNC_{indice:05d}' for indice in range(linhas_relatorio)]
+    workbook = xlsxwriter.Workbook(caminho)
+    planilha = workbook.add_worksheet()
+
+    planilha.write(0, 0, f'Relatório da Análise de ticket do perfil {perfil}')
+    _escrever_mesclado(planilha, 1, LARGURAS_RELATORIO, ['Perfil', 'Sistema', 'Funcionalidade', 'Status'])
+    linha = 2
+    for funcionalidade in funcionalidades:
+        _escrever_mesclado(planilha, linha, LARGURAS_RELATORIO, [perfil, 'RM', funcionalidade, rnd.choice(STATUS_RELATORIO)])
+        linha += 1
+
+    linha += 1
+    planilha.write(linha, 0, f'Riscos SoD para perfil {perfil}')
+    _escrever_mesclado(planilha, linha + 1, LARGURAS_RISCOS, ['ID Risco', 'Descrição', 'Criticidade', 'Aprovador', 'Sistema', 'Módulo', 'Atividade', 'Funcionalidade', 'Atividade', 'Funcionalidade'])
+    linha += 2
+    for indice in range(riscos):
+        func1, func2 = rnd.sample(funcionalidades, 2) if len(funcionalidades) > 1 else (funcionalidades * 2)
+        _escrever_mesclado(planilha, linha, LARGURAS_RISCOS, [
+            f'SOD{indice:05d}', f'Conflito entre {func1} e {func2}', rnd.choice(CRITICIDADES), 'Aprovador',
+            'RM', rnd.choice(MODULOS), 'Atividade 1', func1, 'Atividade 2', func2,
+        ])
+        linha += 1
+
+    linha += 1
+    for indice in range(linhas_rodape):
+        planilha.write_row(linha + indice, 0, ['Rodapé do relatório', '', '', '', indice])
+    workbook.close()
+    return funcionalidades
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='tipo', required=True)
+
+    var = sub.add_parser('var', help='planilha VAR')
+    var.add_argument('saida')
+    var.add_argument('--linhas', type=int, default=10_000)
+    var.add_argument('--semente', type=int, default=0)
+
+    perfil = sub.add_parser('perfil', help='planilha de perfil a partir de uma VAR gerada')
+    perfil.add_argument('saida')
+    perfil.add_argument('--var', required=True, help='planilha VAR de origem')
+    perfil.add_argument('--modulo', default=MODULOS[1])
+    perfil.add_argument('--linhas', type=int, default=500)
+    perfil.add_argument('--taxa-erros', type=float, default=0.2)
+    perfil.add_argument('--taxa-erros-codigo', type=float, default=0.0, help='fração das linhas com o código entre colchetes errado ou renumerado')
+    perfil.add_argument('--semente', type=int, default=0)
+
+    sod = sub.add_parser('sod', help='export SoD do GRC')
+    sod.add_argument('saida')
+    sod.add_argument('--linhas', type=int, default=100, help='linhas do relatório do ticket')
+    sod.add_argument('--riscos', type=int, default=200)
+    sod.add_argument('--semente', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.tipo == 'var':
+        gerar_var(args.saida, args.linhas, semente=args.semente)
+    elif args.tipo == 'perfil':
+        import pandas as pd
+        df_var = pd.read_excel(args.var)
+        nomes = df_var.loc[df_var['modulo'] == args.modulo, 'funcionalidade'].astype(str).tolist()
+        gerar_perfil(args.saida, nomes, args.linhas, args.taxa_erros, semente=args.semente, taxa_erros_codigo=args.taxa_erros_codigo)
+    else:
+        gerar_export_sod(args.saida, args.linhas, args.riscos, semente=args.semente)
+
+
+if __name__ == '__main__':
+    main()
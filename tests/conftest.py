@@ -0,0 +1,11 @@
+"""O app roda setup() ao ser importado: aponta banco e pastas para um diretório temporário antes disso."""
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_pasta = tempfile.mkdtemp(prefix='validador_testes_')
+os.environ['VALIDADOR_DATABASE'] = os.path.join(_pasta, 'sistema.db')
+os.environ['VALIDADOR_UPLOAD_FOLDER'] = os.path.join(_pasta, 'uploads')
+os.environ['VALIDADOR_OUTPUT_FOLDER'] = os.path.join(_pasta, 'outputs')
+sys.path[:0] = [RAIZ, os.path.join(RAIZ, 'benchmarks')]
@@ -0,0 +1,822 @@
+"""Testes de comportamento do motor de comparação e do analisador SoD, com dados de benchmarks/gerar_dados.py."""
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+import xlsxwriter
+from rapidfuzz import fuzz, process
+from werkzeug.datastructures import FileStorage
+
+import app as modulo_app
+import gerar_dados
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    """Banco e pastas vazios só deste teste, com o cache de catálogo zerado."""
+    config = modulo_app.app.config
+    monkeypatch.setitem(config, 'DATABASE', str(tmp_path / 'sistema.db'))
+    monkeypatch.setitem(config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setitem(config, 'OUTPUT_FOLDER', str(tmp_path / 'outputs'))
+    monkeypatch.setitem(config, 'RELATORIOS_SOD_FOLDER', str(tmp_path / 'outputs' / 'relatorios_sod'))
+    modulo_app.setup()
+    modulo_app.trocar_cache_catalogo(None)
+    yield tmp_path
+    modulo_app.trocar_cache_catalogo(None)
+
+
+@pytest.fixture(scope='module')
+def nomes_var():
+    rnd = random.Random(3)
+    return [modulo_app.normalizar_funcionalidade(gerar_dados._nome_funcionalidade(rnd)) for _ in range(2000)]
+
+
+@pytest.fixture(scope='module')
+def consultas(nomes_var):
+    rnd = random.Random(4)
+    consultas = []
+    for _ in range(300):
+        if rnd.random() < 0.5:
+            consultas.append(modulo_app.normalizar_funcionalidade(gerar_dados.aplicar_erro(rnd.choice(nomes_var), rnd)))
+        else:
+            consultas.append(modulo_app.normalizar_funcionalidade(gerar_dados._nome_funcionalidade(rnd)))
+    return consultas
+
+
+# --- cdist x extractOne ---
+def test_sugerir_em_lote_top1_igual_ao_extractone(nomes_var, consultas):
+    resultado = modulo_app.sugerir_em_lote(consultas, nomes_var, 1, 0)
+    for consulta, sugestoes in zip(consultas, resultado):
+        esperado = process.extractOne(consulta, nomes_var, scorer=fuzz.WRatio)
+        assert sugestoes[0][0] == esperado[2], consulta
+        assert sugestoes[0][1] == pytest.approx(esperado[1], abs=1e-3)
+
+
+def test_sugerir_em_lote_topn_igual_ao_extract(nomes_var, consultas):
+    resultado = modulo_app.sugerir_em_lote(consultas, nomes_var, 3, 60)
+    for consulta, sugestoes in zip(consultas, resultado):
+        esperado = process.extract(consulta, nomes_var, scorer=fuzz.WRatio, limit=3, score_cutoff=60)
+        assert [indice for indice, _ in sugestoes] == [item[2] for item in esperado], consulta
+
+
+def test_sugerir_em_lote_desempata_pelo_primeiro_item_da_var():
+    # Quatro nomes com o mesmo score: o corte do top_n fica com os de menor índice.
+    var = ['cadastro x', 'outra coisa'] + ['cadastro y'] * 4
+    assert [indice for indice, _ in modulo_app.sugerir_em_lote(['cadastro z'], var, 2, 0)[0]] == [0, 2]
+
+
+# --- escopo hierárquico ---
+VAR_HIERARQUICA = [
+    '[01] folha', '[01.01] cadastro funcionario', '[01.01.01] inclusao de funcionario',
+    '[02] ferias', '[02.01] cadastro funcionario', '[02.01.01] inclusao de funcionario',
+    '[03] relatorios', '[03.01] relatorio geral anual',
+]
+
+
+@pytest.fixture
+def catalogo_hierarquico():
+    lista_norm = [modulo_app.normalizar_funcionalidade(nome) for nome in VAR_HIERARQUICA]
+    return {'lista_norm': lista_norm, 'posicao_por_rowid': {}, 'indice': modulo_app.montar_indice_hierarquico(lista_norm, VAR_HIERARQUICA)}
+
+
+def test_definir_escopos(catalogo_hierarquico):
+    indice = catalogo_hierarquico['indice']
+    usuario = [modulo_app.normalizar_funcionalidade(nome) for nome in [
+        '[01.01.05] item novo',  # código inexistente: ancestral mais próximo
+        'sem codigo',  # herda o último código casado (01.01.05 não existe na VAR nem casou)
+        '[02.01] cadastro funcionario',
+        'outra sem codigo',  # herda 02.01 -> escopo 02
+        '[09.01] fora da var',
+    ]]
+    assert modulo_app.definir_escopos(usuario, {2}, indice) == ['01.01', None, '02', '02', None]
+
+
+def test_sugerir_por_hierarquia_prefere_o_ramo_e_cai_para_o_modulo(catalogo_hierarquico):
+    consultas = [modulo_app.normalizar_funcionalidade(nome) for nome in ['inclusao de funcionario', 'relatorio geral anuall']]
+    # Sem escopo, o empate entre os dois "inclusao de funcionario" fica com o primeiro da VAR.
+    assert modulo_app.sugerir_por_hierarquia(consultas[:1], [None], catalogo_hierarquico, 1, 80)[0][0][0] == 2
+    sugestoes = modulo_app.sugerir_por_hierarquia(consultas, ['02', '02'], catalogo_hierarquico, 1, 80)
+    assert sugestoes[0][0][0] == 5  # dentro do ramo 02
+    assert sugestoes[1][0][0] == 7  # nada no ramo 02 acima do score mínimo: busca no módulo inteiro
+
+
+def test_codigo_renumerado_nao_prende_a_sugestao_no_ramo_errado(catalogo_hierarquico):
+    # O item foi renumerado de 03.01 para 01.01.09: o ramo 01.01 só tem nós parecidos pelo prefixo do código.
+    consultas = [modulo_app.normalizar_funcionalidade(nome) for nome in ['[01.01.09] relatorio geral anual', '[02.01.07] inclusao de funcionarios']]
+    escopos = modulo_app.definir_escopos(consultas, set(), catalogo_hierarquico['indice'])
+    assert escopos == ['01.01', '02.01']
+    sugestoes = modulo_app.sugerir_por_hierarquia(consultas, escopos, catalogo_hierarquico, 3, 50)
+    assert [posicao for posicao, _ in sugestoes[0]] == [7, 6]
+    assert sugestoes[0][0][1] == pytest.approx(100)
+    # Empate com o outro ramo: o código ainda decide.
+    assert [posicao for posicao, _ in sugestoes[1]][:2] == [5, 2]
+
+
+def test_perfil_com_erros_de_codigo_mantem_o_nome(tmp_path):
+    nomes = gerar_dados.gerar_var(str(tmp_path / 'var.xlsx'), 200, semente=5)[gerar_dados.MODULOS[0]]
+    linhas = gerar_dados.gerar_perfil(str(tmp_path / 'perfil.xlsx'), nomes, 15, taxa_erros=0, taxa_inexistentes=0, semente=5, taxa_erros_codigo=1)
+    for funcionalidade, origem in linhas:
+        assert modulo_app.extrair_codigo_var(funcionalidade) != modulo_app.extrair_codigo_var(origem)
+        assert modulo_app.PADRAO_CODIGO_VAR.sub('', funcionalidade) == modulo_app.PADRAO_CODIGO_VAR.sub('', origem)
+    assert pd.read_excel(tmp_path / 'perfil.xlsx')['Funcionalidade'].tolist() == [funcionalidade for funcionalidade, _ in linhas]
+
+
+# --- leitura do export SoD ---
+def _consolidar_como_antes(df_bruto, grupos):
+    """Reconstrução original: fatias do pd.read_excel com as colunas mescladas concatenadas como texto."""
+    return pd.DataFrame({
+        nome: df_bruto.iloc[:, inicio:min(fim, len(df_bruto.columns))].fillna('').astype(str).agg(''.join, axis=1)
+        for nome, inicio, fim in grupos
+    }).reset_index(drop=True)
+
+
+def test_ler_tabelas_sod_igual_ao_read_excel(tmp_path):
+    caminho = str(tmp_path / 'export.xlsx')
+    gerar_dados.gerar_export_sod(caminho, 40, 70, perfil='PERFIL_TESTE')
+    tabelas = modulo_app.ler_tabelas_sod(caminho)
+
+    df_bruto = pd.read_excel(caminho, header=None, sheet_name=0)
+    titulos = df_bruto.iloc[:, 0].astype(str)
+    linha_t1 = titulos[titulos.str.contains(modulo_app.TITULO_RELATORIO_SOD)].index[0]
+    linha_t2 = titulos[titulos.str.contains(modulo_app.TITULO_RISCOS_SOD)].index[0]
+    assert (tabelas['linha_titulo_t1'], tabelas['linha_titulo_t2']) == (linha_t1, linha_t2)
+    assert tabelas['titulo_t1'].endswith('PERFIL_TESTE')
+
+    esperado_t1 = _consolidar_como_antes(df_bruto.iloc[linha_t1 + 2:linha_t2 - 1], modulo_app.GRUPOS_RELATORIO_SOD)
+    obtido_t1 = modulo_app.consolidar_grupos(tabelas['linhas_t1'], modulo_app.GRUPOS_RELATORIO_SOD, modulo_app.LARGURA_RELATORIO_SOD)
+    pd.testing.assert_frame_equal(obtido_t1, esperado_t1)
+
+    # A tabela de riscos termina na primeira linha vazia; o rodapé do relatório não entra.
+    bloco_t2 = df_bruto.iloc[linha_t2 + 2:]
+    fim_t2 = bloco_t2.index[bloco_t2.isna().all(axis=1)][0]
+    esperado_t2 = _consolidar_como_antes(df_bruto.iloc[linha_t2 + 2:fim_t2], modulo_app.GRUPOS_RISCOS_SOD)
+    obtido_t2 = modulo_app.consolidar_grupos(tabelas['linhas_t2'], modulo_app.GRUPOS_RISCOS_SOD, modulo_app.LARGURA_RISCOS_SOD)
+    pd.testing.assert_frame_equal(obtido_t2, esperado_t2)
+    assert len(obtido_t1) == 40 and len(obtido_t2) == 70
+
+
+# --- busca de riscos pelos dois lados do par ---
+RELATORIO_SOD = [('A', 'Adicionado'), ('B', 'Adicionado'), ('C', 'Mantido'), ('D', 'Removido')]
+RISCOS_SOD = [('R1', 'A', 'B'), ('R2', 'C', 'A'), ('R3', 'A', 'D'), ('R4', 'E', 'F')]
+
+
+def _escrever_export(caminho):
+    workbook = xlsxwriter.Workbook(caminho)
+    planilha = workbook.add_worksheet()
+    planilha.write(0, 0, f'{modulo_app.TITULO_RELATORIO_SOD} PERFIL_TESTE')
+    gerar_dados._escrever_mesclado(planilha, 1, gerar_dados.LARGURAS_RELATORIO, ['Perfil', 'Sistema', 'Funcionalidade', 'Status'])
+    for linha, (funcionalidade, status) in enumerate(RELATORIO_SOD, start=2):
+        gerar_dados._escrever_mesclado(planilha, linha, gerar_dados.LARGURAS_RELATORIO, ['PERFIL_TESTE', 'RM', funcionalidade, status])
+    linha = len(RELATORIO_SOD) + 3
+    planilha.write(linha, 0, f'{modulo_app.TITULO_RISCOS_SOD} PERFIL_TESTE')
+    gerar_dados._escrever_mesclado(planilha, linha + 1, gerar_dados.LARGURAS_RISCOS, [nome for nome, _, _ in modulo_app.GRUPOS_RISCOS_SOD])
+    for deslocamento, (id_risco, func1, func2) in enumerate(RISCOS_SOD, start=2):
+        gerar_dados._escrever_mesclado(planilha, linha + deslocamento, gerar_dados.LARGURAS_RISCOS,
+                                       [id_risco, f'{func1} x {func2}', 'Alta', 'Aprovador', 'RM', 'Folha', 'At 1', func1, 'At 2', func2])
+    workbook.close()
+
+
+def _riscos_por_funcionalidade(resultado):
+    return {func: sorted((item['ID Risco'], item['Entre adicionadas']) for item in itens) for func, itens in resultado['data'].items()}
+
+
+def test_indexar_riscos_encontra_os_dois_lados():
+    riscos = [{'ID Risco': id_risco, 'Funcionalidade': func1, 'Funcionalidade 2': func2} for id_risco, func1, func2 in RISCOS_SOD]
+    ocorrencias = modulo_app.indexar_riscos(riscos, {'A', 'B'})
+    assert sorted((o['funcionalidade'], o['risco']['ID Risco'], o['conflitante']) for o in ocorrencias) == [
+        ('A', 'R1', 'B'), ('A', 'R2', 'C'), ('A', 'R3', 'D'), ('B', 'R1', 'A'),
+    ]
+
+
+def test_analise_com_matriz_marca_conflitos_entre_adicionadas(tmp_path):
+    caminho = str(tmp_path / 'ticket.xlsx')
+    _escrever_export(caminho)
+    conn = modulo_app.get_db_connection()
+    with conn:
+        matriz_id = modulo_app.carregar_matriz_riscos(conn, modulo_app.ler_matriz_riscos(caminho), 'matriz.xlsx')
+
+    resultado = modulo_app.analisar_riscos_excel(caminho, 'manutencao', matriz_id)
+    assert resultado['status'] == 'success'
+    # R2 só tem A no segundo lado; R3 conflita com D, removida do perfil; R4 não envolve o ticket.
+    assert _riscos_por_funcionalidade(resultado) == {'A': [('R1', True), ('R2', False)], 'B': [('R1', True)]}
+    assert 'incluindo 1 conflito(s)' in resultado['message']
+
+    sem_matriz = modulo_app.analisar_riscos_excel(caminho, 'manutencao')
+    assert _riscos_por_funcionalidade(sem_matriz) == {'A': [('R1', True), ('R2', False), ('R3', False)], 'B': [('R1', True)]}
+
+
+# --- migração do dados_var legado ---
+def _criar_banco_legado(caminho):
+    """Esquema anterior ao staging: uma tabela dados_var reescrita a cada ativação."""
+    conn = sqlite3.connect(caminho)
+    conn.execute('CREATE TABLE uploads_historico (id INTEGER PRIMARY KEY AUTOINCREMENT, nome_arquivo_original TEXT NOT NULL, '
+                 'nome_arquivo_salvo TEXT NOT NULL, timestamp DATETIME NOT NULL, status TEXT NOT NULL)')
+    conn.execute('CREATE TABLE dados_var ("ID Funcionalidade" TEXT, "Funcionalidade" TEXT, "ID Módulo" TEXT, "Módulo" TEXT)')
+    conn.execute("INSERT INTO uploads_historico VALUES (1, 'v1.xlsx', 'v1.xlsx', '2025-01-01 10:00:00', 'Arquivado')")
+    conn.execute("INSERT INTO uploads_historico VALUES (2, 'v2.xlsx', 'v2.xlsx', '2025-01-02 10:00:00', 'Ativo')")
+    conn.executemany('INSERT INTO dados_var VALUES (?, ?, ?, ?)', [('10', 'Cadastro', '1', 'Folha'), ('11', 'Relatório', '1', 'Folha'), ('20', 'Lançamento', '2', 'Contábil')])
+    conn.commit()
+    conn.close()
+
+
+def test_migrar_dados_var_legado_com_workers_subindo_juntos(banco):
+    caminho = str(banco / 'legado.db')
+    _criar_banco_legado(caminho)
+    modulo_app.app.config['DATABASE'] = caminho
+    barreira = threading.Barrier(4)
+    erros = []
+
+    def subir_worker():
+        barreira.wait()
+        try:
+            modulo_app.init_db()
+        except Exception as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=subir_worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert erros == []
+
+    conn = modulo_app.get_db_connection()
+    objetos = {(row['type'], row['name']) for row in conn.execute("SELECT type, name FROM sqlite_master WHERE name IN ('dados_var', 'var_1', 'var_2')")}
+    assert objetos == {('view', 'dados_var'), ('table', 'var_2')}
+    assert modulo_app.obter_versao_var(conn) == 2
+    assert [row['Funcionalidade_norm'] for row in conn.execute('SELECT "Funcionalidade_norm" FROM dados_var ORDER BY id')] == ['cadastro', 'relatório', 'lançamento']
+    modulo_app.init_db()  # já migrado: não faz nada
+    assert modulo_app.obter_modulos_var(conn) == ['Contábil', 'Folha']
+
+
+# --- staging e ativação da VAR ---
+def _enviar_var(cliente, pasta, semente, linhas=90):
+    caminho = str(pasta / f'var_{semente}.xlsx')
+    nomes = gerar_dados.gerar_var(caminho, linhas, semente=semente)
+    with open(caminho, 'rb') as arquivo:
+        assert cliente.post('/upload_var', data={'file': (arquivo, f'var_{semente}.xlsx')}, content_type='multipart/form-data').status_code == 302
+    return nomes
+
+
+def _tabelas_var(conn):
+    return sorted(row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'var_[0-9]*' AND name NOT LIKE '%fts%'"))
+
+
+def _status_uploads(conn):
+    return dict(conn.execute('SELECT id, status FROM uploads_historico').fetchall())
+
+
+def _comparar(cliente, pasta, nomes, modulo=gerar_dados.MODULOS[1], semente=1, **campos):
+    caminho = str(pasta / 'perfil.xlsx')
+    gerar_dados.gerar_perfil(caminho, nomes, 20, taxa_erros=0.3, semente=semente)
+    with open(caminho, 'rb') as arquivo:
+        return cliente.post('/comparar', data={'modulo': modulo, 'arquivo_analise': (arquivo, 'perfil.xlsx'), **campos}, content_type='multipart/form-data')
+
+
+def test_ativar_var_troca_a_view(banco):
+    cliente = modulo_app.app.test_client()
+    nomes_1 = _enviar_var(cliente, banco, 1)
+    nomes_2 = _enviar_var(cliente, banco, 2)
+    conn = modulo_app.get_db_connection()
+    assert not modulo_app.var_ativa_disponivel(conn)
+
+    for upload_id, nomes in ((1, nomes_1), (2, nomes_2)):
+        assert modulo_app.ativar_planilha_var(upload_id)[0]
+        sql_view = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'dados_var'").fetchone()['sql']
+        assert sql_view.endswith(f'FROM {modulo_app.tabela_var(upload_id)}')
+        assert [row['Funcionalidade'] for row in conn.execute('SELECT "Funcionalidade" FROM dados_var ORDER BY id')] == [nome for lista in nomes.values() for nome in lista]
+    assert _status_uploads(conn) == {1: 'Arquivado', 2: 'Ativo'}
+
+    resposta = _comparar(cliente, banco, nomes_2[gerar_dados.MODULOS[1]])
+    assert resposta.status_code == 200 and resposta.get_json()['contagem_status'].get('Encontrado')
+
+
+def test_comparar_recusa_modulo_ausente_ou_fora_da_var(banco):
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    funcionalidades = nomes[gerar_dados.MODULOS[1]]
+
+    for modulo, assincrono in (('', ''), ('Módulo Inexistente', ''), ('Módulo Inexistente', '1')):
+        resposta = _comparar(cliente, banco, funcionalidades, modulo=modulo, assincrono=assincrono)
+        assert resposta.status_code == 400, modulo
+        assert 'módulo' in resposta.get_json()['erro']
+    assert modulo_app.executar_comparacao(b'', None, 3, 80)[1] == 400
+
+    assert _comparar(cliente, banco, funcionalidades).status_code == 200
+    automatico = _comparar(cliente, banco, funcionalidades, modulo=modulo_app.MODULO_AUTOMATICO)
+    assert automatico.status_code == 200 and automatico.get_json()['modulo'] == gerar_dados.MODULOS[1]
+
+
+def test_reativar_upload_antigo_reconstroi_a_tabela_descartada(banco, monkeypatch):
+    monkeypatch.setattr(modulo_app, 'VAR_TABELAS_MANTIDAS', 1)
+    cliente = modulo_app.app.test_client()
+    nomes_1 = _enviar_var(cliente, banco, 1)
+    _enviar_var(cliente, banco, 2)
+    conn = modulo_app.get_db_connection()
+    assert _tabelas_var(conn) == ['var_2']
+
+    assert modulo_app.ativar_planilha_var(1)[0]
+    assert _tabelas_var(conn) == ['var_1', 'var_2']
+    assert _status_uploads(conn) == {1: 'Ativo', 2: 'Válido'}
+    assert conn.execute('SELECT COUNT(*) FROM dados_var').fetchone()[0] == sum(len(lista) for lista in nomes_1.values())
+
+
+def test_limpar_tabelas_var_mantem_a_ativa_e_as_mais_recentes(banco, monkeypatch):
+    monkeypatch.setattr(modulo_app, 'VAR_TABELAS_MANTIDAS', 2)
+    cliente = modulo_app.app.test_client()
+    for semente in range(1, 5):
+        _enviar_var(cliente, banco, semente, linhas=20)
+    conn = modulo_app.get_db_connection()
+    assert _tabelas_var(conn) == ['var_3', 'var_4']
+
+    assert modulo_app.ativar_planilha_var(1)[0]
+    assert _tabelas_var(conn) == ['var_1', 'var_3', 'var_4']
+
+    # Inválidos e tabelas sem upload saem; a ativa fica mesmo sendo a mais antiga.
+    with conn:
+        conn.execute('UPDATE uploads_historico SET status = "Inválido" WHERE id = 4')
+        conn.execute('CREATE TABLE var_99 (id INTEGER PRIMARY KEY)')
+        modulo_app.limpar_tabelas_var(conn)
+    assert _tabelas_var(conn) == ['var_1', 'var_3']
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name GLOB 'var_4_fts*'").fetchone()[0] == 0
+
+
+def test_falha_antes_do_commit_marca_invalido_e_mantem_a_var_ativa(banco, monkeypatch):
+    monkeypatch.setattr(modulo_app, 'VAR_TABELAS_MANTIDAS', 1)
+    cliente = modulo_app.app.test_client()
+    _enviar_var(cliente, banco, 1)
+    _enviar_var(cliente, banco, 2)
+    assert modulo_app.ativar_planilha_var(2)[0]
+    conn = modulo_app.get_db_connection()
+    for nome in conn.execute('SELECT nome_arquivo_salvo FROM uploads_historico WHERE id = 1').fetchone():
+        (banco / 'uploads' / nome).unlink()
+
+    sucesso, _ = modulo_app.ativar_planilha_var(1)
+    assert not sucesso
+    assert _status_uploads(conn) == {1: 'Inválido', 2: 'Ativo'}
+    assert modulo_app.obter_versao_var(conn) == 2 and modulo_app.var_ativa_disponivel(conn)
+
+
+def test_falha_ao_aquecer_o_catalogo_nao_desfaz_a_ativacao(banco, monkeypatch):
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1)
+    def sem_memoria(*args, **kwargs):
+        raise MemoryError
+
+    monkeypatch.setattr(modulo_app, 'ler_dados_var_completa', sem_memoria)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    conn = modulo_app.get_db_connection()
+    assert _status_uploads(conn) == {1: 'Ativo'}
+    assert modulo_app.obter_versao_var(conn) == 1
+    # O catálogo é montado sob demanda na primeira comparação.
+    assert _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]]).status_code == 200
+
+
+# --- análise SoD em lote ---
+def _zip_de_exports(caminho_export, nomes_membros):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as pacote:
+        for nome in nomes_membros:
+            pacote.write(caminho_export, nome)
+        pacote.writestr('leia-me.txt', 'ignorado')
+    buffer.seek(0)
+    return buffer
+
+
+def _pastas_de_lote(banco):
+    return [nome for nome in os.listdir(banco / 'uploads') if nome.startswith('lote_sod_')]
+
+
+def test_lote_sod_analisa_avulsos_e_zip(banco):
+    caminho = str(banco / 'ticket.xlsx')
+    _escrever_export(caminho)
+    cliente = modulo_app.app.test_client()
+    with open(caminho, 'rb') as arquivo:
+        arquivos = [(arquivo, 'avulso.xlsx'), (_zip_de_exports(caminho, ['um.xlsx', 'sub/dois.xlsx']), 'lote.zip')]
+        resposta = cliente.post('/sod_analyzer', data={'file': arquivos, 'analysis_type': 'manutencao'}, content_type='multipart/form-data')
+    assert resposta.status_code == 200
+    pagina = resposta.get_data(as_text=True)
+    for nome in ('avulso.xlsx', 'um.xlsx', 'dois.xlsx'):
+        assert nome in pagina
+    relatorios = os.listdir(banco / 'outputs' / 'relatorios_sod')
+    assert len(relatorios) == 1 and relatorios[0] in pagina
+    assert _pastas_de_lote(banco) == []
+
+    resumo = pd.read_excel(banco / 'outputs' / 'relatorios_sod' / relatorios[0], sheet_name='Resumo')
+    assert resumo['Arquivo'].tolist() == ['avulso.xlsx', 'um.xlsx', 'dois.xlsx']
+    assert resumo['Status'].tolist() == ['success'] * 3 and resumo['Riscos'].tolist() == [4] * 3
+
+
+def test_lote_sod_recusa_zip_acima_dos_limites(banco, monkeypatch):
+    caminho = str(banco / 'ticket.xlsx')
+    _escrever_export(caminho)
+    monkeypatch.setattr(modulo_app, 'MAX_ARQUIVOS_ZIP', 2)
+    cliente = modulo_app.app.test_client()
+    resposta = cliente.post('/sod_analyzer', data={'file': (_zip_de_exports(caminho, ['a.xlsx', 'b.xlsx', 'c.xlsx']), 'lote.zip')}, content_type='multipart/form-data')
+    assert resposta.status_code == 302
+    with cliente.session_transaction() as sessao:
+        assert sessao['_flashes'] == [('danger', 'O lote tem mais de 2 planilhas dentro de arquivos .zip.')]
+    assert _pastas_de_lote(banco) == []
+
+    # O limite de planilhas soma todos os .zip do lote.
+    pasta = banco / 'lote'
+    pasta.mkdir()
+    with pytest.raises(ValueError, match='mais de 2 planilhas'):
+        modulo_app.extrair_arquivos_lote([FileStorage(_zip_de_exports(caminho, [nome]), f'{nome}.zip') for nome in ('a.xlsx', 'b.xlsx', 'c.xlsx')], str(pasta))
+
+    monkeypatch.setattr(modulo_app, 'MAX_ARQUIVOS_ZIP', 500)
+    monkeypatch.setattr(modulo_app, 'MAX_BYTES_ZIP_DESCOMPACTADO', 2 * os.path.getsize(caminho) - 1)
+    with pytest.raises(ValueError, match='descompactadas'):
+        modulo_app.extrair_arquivos_lote([FileStorage(_zip_de_exports(caminho, ['a.xlsx', 'b.xlsx']), 'lote.zip')], str(pasta))
+
+
+def test_lote_sod_extrai_membros_do_zip_so_dentro_da_pasta_do_lote(banco):
+    caminho = str(banco / 'ticket.xlsx')
+    _escrever_export(caminho)
+    pasta = banco / 'uploads' / 'lote'
+    pasta.mkdir()
+    membros = ['../../fora.xlsx', '/tmp/absoluto.xlsx', 'dentro/../../../subiu.xlsx']
+    extraidos = modulo_app.extrair_arquivos_lote([FileStorage(_zip_de_exports(caminho, membros), 'lote.zip')], str(pasta))
+
+    assert [nome for nome, _, _ in extraidos] == ['fora.xlsx', 'absoluto.xlsx', 'subiu.xlsx']
+    assert all(os.path.dirname(caminho_extraido) == str(pasta) for _, caminho_extraido, _ in extraidos)
+    assert sorted(os.listdir(pasta)) == sorted(os.path.basename(caminho_extraido) for _, caminho_extraido, _ in extraidos)
+    assert not any((banco / nome).exists() for nome in ('fora.xlsx', 'subiu.xlsx')) and not os.path.exists('/tmp/absoluto.xlsx')
+
+
+def test_lote_sod_se_recupera_de_um_worker_morto(banco, monkeypatch):
+    caminho = str(banco / 'ticket.xlsx')
+    _escrever_export(caminho)
+
+    def lote(nome, cenario='manutencao'):
+        with open(caminho, 'rb') as arquivo:
+            return modulo_app.processar_lote_sod(*modulo_app.preparar_lote_sod([FileStorage(arquivo, nome)]), cenario, None)
+
+    # O worker morre no meio do lote: o arquivo sai com erro e o pool quebrado é descartado.
+    enviar_ao_pool_sod = modulo_app.enviar_ao_pool_sod
+
+    def matar_worker(*args):
+        pool = modulo_app.obter_pool_sod()
+        return pool.submit(os._exit, 1), pool
+
+    monkeypatch.setattr(modulo_app, 'enviar_ao_pool_sod', matar_worker)
+    pool_quebrado = modulo_app.obter_pool_sod()
+    resultado = lote('morre.xlsx')['arquivos'][0]
+    assert resultado['status'] == 'error' and 'encerrado inesperadamente' in resultado['message']
+    assert modulo_app._pool_sod is not pool_quebrado
+
+    monkeypatch.setattr(modulo_app, 'enviar_ao_pool_sod', enviar_ao_pool_sod)
+    assert lote('ok.xlsx')['arquivos'][0]['status'] == 'success'
+
+    # Pool que quebrou entre dois lotes: o envio é refeito em um pool novo (outro cenário, para não vir do cache).
+    pool_quebrado = modulo_app.obter_pool_sod()
+    with pytest.raises(BrokenProcessPool):
+        pool_quebrado.submit(os._exit, 1).result()
+    resultado = lote('depois.xlsx', 'criacao')['arquivos'][0]
+    assert resultado['status'] == 'success' and resultado['cache'] is False
+    assert modulo_app._pool_sod is not pool_quebrado
+
+
+# --- cache do catálogo VAR ---
+@pytest.fixture
+def leituras_catalogo(monkeypatch):
+    """(versão, módulo) de cada leitura do catálogo no SQLite."""
+    leituras = []
+    ler_dados_var = modulo_app.ler_dados_var
+
+    def ler_e_registrar(conn, versao_var, modulo):
+        leituras.append((versao_var, modulo))
+        return ler_dados_var(conn, versao_var, modulo)
+
+    monkeypatch.setattr(modulo_app, 'ler_dados_var', ler_e_registrar)
+    return leituras
+
+
+def test_catalogo_lido_uma_vez_por_versao_e_modulo(banco, leituras_catalogo):
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    # A ativação já deixa todos os módulos aquecidos.
+    assert _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]], semente=1).status_code == 200
+    assert leituras_catalogo == []
+
+    modulo_app.trocar_cache_catalogo(None)
+    for semente in (2, 3):  # perfis diferentes: o cache de resultados não responde
+        resposta = _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]], semente=semente)
+        assert resposta.status_code == 200 and not resposta.get_json()['cache']
+    assert leituras_catalogo == [(1, gerar_dados.MODULOS[1])]
+
+
+def test_ativar_outra_var_invalida_o_catalogo(banco, leituras_catalogo):
+    cliente = modulo_app.app.test_client()
+    _enviar_var(cliente, banco, 1)
+    nomes_2 = _enviar_var(cliente, banco, 2)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    catalogo_1 = modulo_app.obter_catalogo_var(modulo_app.get_db_connection(), gerar_dados.MODULOS[1])
+
+    assert modulo_app.ativar_planilha_var(2)[0]
+    catalogo_2 = modulo_app.obter_catalogo_var(modulo_app.get_db_connection(), gerar_dados.MODULOS[1])
+    assert catalogo_2 is not catalogo_1
+    assert catalogo_2['nomes_originais'] == nomes_2[gerar_dados.MODULOS[1]]
+    assert leituras_catalogo == []  # as duas ativações aqueceram o cache
+    resposta = _comparar(cliente, banco, nomes_2[gerar_dados.MODULOS[1]])
+    assert resposta.get_json()['contagem_status'].get('Encontrado')
+
+
+def test_catalogo_chaveado_pela_versao_da_var(banco, leituras_catalogo):
+    cliente = modulo_app.app.test_client()
+    nomes_1 = _enviar_var(cliente, banco, 1)
+    nomes_2 = _enviar_var(cliente, banco, 2)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    conn = modulo_app.get_db_connection()
+    modulo = gerar_dados.MODULOS[1]
+
+    # Outro worker ativou a versão 2 sem passar por este processo: a versão lida do banco decide.
+    with modulo_app.transacao(conn):
+        conn.execute('UPDATE uploads_historico SET status = CASE id WHEN 2 THEN "Ativo" ELSE "Arquivado" END')
+        modulo_app.apontar_dados_var(conn, 2)
+    assert modulo_app.obter_catalogo_var(conn, modulo)['nomes_originais'] == nomes_2[modulo]
+    assert leituras_catalogo == [(2, modulo)]
+
+    # Uma comparação que começou na versão 1 monta essa versão sem trocar o cache da ativa.
+    assert modulo_app.obter_catalogo_var(conn, modulo, versao=1)['nomes_originais'] == nomes_1[modulo]
+    assert modulo_app.obter_catalogo_var(conn, modulo)['nomes_originais'] == nomes_2[modulo]
+    assert leituras_catalogo == [(2, modulo), (1, modulo)]
+
+
+# --- sessões de análise e planilha de importação ---
+def _importacao_como_antes(df_analise, perfil_id, perfil_nome):
+    """A montagem linha a linha (apply) que montar_colunas_importacao substituiu."""
+    get_final_id = lambda row: (str(row.get('ID Encontrado', '')).strip() or str(row.get('ID Sugerido', '')).strip()) or '❗ Não encontrado'
+    def get_final_funcionalidade(row):
+        sugestao_var = str(row.get('Sugestão Similar (VAR)', '')).strip()
+        return sugestao_var if row.get('Status') in ['Encontrado', 'Divergente com Sugestão'] and sugestao_var else row.get('Funcionalidade Analisada', '')
+
+    df_importacao = pd.DataFrame()
+    df_importacao['funcionalidade'] = df_analise.apply(get_final_funcionalidade, axis=1)
+    df_importacao['funcionalidade id'] = df_analise.apply(get_final_id, axis=1)
+    df_importacao['id'] = perfil_id
+    df_importacao['perfil'] = perfil_nome
+    return df_importacao[['id', 'perfil', 'funcionalidade id', 'funcionalidade']]
+
+
+RESULTADOS_LEGADOS = [
+    {'Status': 'Encontrado', 'Funcionalidade Analisada': 'cadastro', 'ID Encontrado': 10, 'ID Sugerido': '', 'Sugestão Similar (VAR)': ' Cadastro '},
+    {'Status': 'Encontrado', 'Funcionalidade Analisada': 'sem nome na var', 'ID Encontrado': ' 11 ', 'ID Sugerido': '', 'Sugestão Similar (VAR)': '  '},
+    {'Status': 'Divergente com Sugestão', 'Funcionalidade Analisada': 'relatorio', 'ID Encontrado': '', 'ID Sugerido': 12, 'Sugestão Similar (VAR)': 'Relatório'},
+    {'Status': 'Divergente com Sugestão', 'Funcionalidade Analisada': 'lancamento', 'ID Encontrado': '  ', 'ID Sugerido': ' 13', 'Sugestão Similar (VAR)': ''},
+    {'Status': 'Divergente', 'Funcionalidade Analisada': 'personalizado', 'ID Encontrado': '', 'ID Sugerido': '', 'Sugestão Similar (VAR)': 'ignorada'},
+]
+
+
+def _baixar_importacao(cliente, formato, **corpo):
+    resposta = cliente.post('/gerar_importacao', json={'perfil_id': '7', 'perfil_nome': 'PERFIL_TESTE', 'formato': formato, **corpo})
+    assert resposta.status_code == 200
+    conteudo = io.BytesIO(resposta.get_data())
+    if formato == 'csv':
+        return pd.read_csv(conteudo, sep=';', dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    return pd.read_excel(conteudo, dtype=str, keep_default_na=False)
+
+
+def test_montar_colunas_importacao_igual_ao_apply(banco):
+    df_legado = pd.DataFrame(RESULTADOS_LEGADOS)
+    esperado = _importacao_como_antes(df_legado, '7', 'PERFIL_TESTE').astype(str)
+    pd.testing.assert_frame_equal(modulo_app.montar_colunas_importacao(df_legado, '7', 'PERFIL_TESTE').astype(str), esperado)
+
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    analise_id = _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]]).get_json()['analise_id']
+    resultados = [json.loads(linha) for linha in cliente.get(f'/analises/{analise_id}?formato=ndjson').get_data(as_text=True).splitlines()]
+    assert {item['Status'] for item in resultados} >= {'Encontrado', 'Divergente com Sugestão'}
+
+    # Gravada no servidor (xlsx e csv) ou enviada no corpo, como o front-end antigo fazia.
+    for resultados_base, corpo in ((resultados, {'analise_id': analise_id}), (RESULTADOS_LEGADOS, {'resultados': RESULTADOS_LEGADOS})):
+        esperado = _importacao_como_antes(pd.DataFrame(resultados_base), '7', 'PERFIL_TESTE').astype(str)
+        for formato in ('xlsx', 'csv'):
+            pd.testing.assert_frame_equal(_baixar_importacao(cliente, formato, **corpo), esperado, obj=f'{formato} {list(corpo)}')
+
+
+def test_paginas_filtro_e_ndjson_da_analise(banco):
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1, linhas=180)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    resposta = _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]]).get_json()
+    analise_id, total = resposta['analise_id'], resposta['total']
+    assert total == 20
+
+    def pagina(**parametros):
+        resposta = cliente.get(f'/analises/{analise_id}', query_string=parametros)
+        return resposta.status_code, resposta.get_json()
+
+    todos = pagina(tamanho_pagina=total)[1]['resultados']
+    paginas = [pagina(pagina=numero, tamanho_pagina=7)[1] for numero in (1, 2, 3, 4)]
+    assert [len(p['resultados']) for p in paginas] == [7, 7, 6, 0]
+    assert all(p['total'] == total and p['total_paginas'] == 3 for p in paginas)
+    assert [item for p in paginas for item in p['resultados']] == todos
+    assert pagina(tamanho_pagina=5)[1]['total_paginas'] == 4  # divisão exata
+    for invalido in ({'pagina': 0}, {'tamanho_pagina': 0}, {'tamanho_pagina': modulo_app.TAMANHO_PAGINA_MAXIMO + 1}, {'pagina': 'x'}):
+        assert pagina(**invalido)[0] == 400, invalido
+    assert cliente.get('/analises/inexistente').status_code == 404
+
+    contagem = resposta['contagem_status']
+    encontrados = pagina(status='Encontrado', tamanho_pagina=3)[1]
+    assert encontrados['total'] == contagem['Encontrado'] and encontrados['status'] == ['Encontrado']
+    assert {item['Status'] for item in encontrados['resultados']} == {'Encontrado'}
+    varios = pagina(status=['Divergente', 'Divergente com Sugestão'], tamanho_pagina=total)[1]
+    assert varios['resultados'] == [item for item in todos if item['Status'] != 'Encontrado']
+
+    ndjson = cliente.get(f'/analises/{analise_id}', query_string={'formato': 'ndjson', 'pagina': 2, 'tamanho_pagina': 1})
+    assert ndjson.mimetype == 'application/x-ndjson'
+    assert [json.loads(linha) for linha in ndjson.get_data(as_text=True).splitlines()] == todos  # ignora a paginação
+    filtrado = cliente.get(f'/analises/{analise_id}', query_string={'formato': 'ndjson', 'status': 'Encontrado'}).get_data(as_text=True)
+    assert [json.loads(linha) for linha in filtrado.splitlines()] == [item for item in todos if item['Status'] == 'Encontrado']
+
+
+# --- tarefas em segundo plano ---
+class ExecutorManual:
+    """Guarda as tarefas enviadas; o teste decide quando cada uma roda."""
+    def __init__(self):
+        self.enviadas = []
+
+    def submit(self, funcao, *args):
+        self.enviadas.append((funcao, args))
+
+
+def _status_tarefa(cliente, tarefa_id):
+    resposta = cliente.get(f'/tarefas/{tarefa_id}')
+    assert resposta.status_code == 200
+    return resposta.get_json()
+
+
+def test_ciclo_de_vida_da_tarefa(banco, monkeypatch):
+    executor = ExecutorManual()
+    monkeypatch.setattr(modulo_app, '_executor_tarefas', executor)
+    cliente = modulo_app.app.test_client()
+    em_execucao, liberar = threading.Event(), threading.Event()
+
+    def trabalho(valor, progresso):
+        progresso('Processando', 1, 2)
+        em_execucao.set()
+        liberar.wait(10)
+        return {'dobro': valor * 2}
+
+    tarefa_id = modulo_app.criar_tarefa('teste', trabalho, 21)
+    assert _status_tarefa(cliente, tarefa_id)['status'] == 'Na fila'
+
+    funcao, args = executor.enviadas.pop()
+    thread = threading.Thread(target=funcao, args=args)
+    thread.start()
+    assert em_execucao.wait(10)
+    status = _status_tarefa(cliente, tarefa_id)
+    assert (status['status'], status['etapa'], status['progresso'], status['total']) == ('Executando', 'Processando', 1, 2)
+    assert 'resultado' not in status
+    liberar.set()
+    thread.join(10)
+    status = _status_tarefa(cliente, tarefa_id)
+    assert (status['status'], status['resultado'], status['erro']) == ('Concluída', {'dobro': 42}, None)
+
+    def falha(progresso):
+        raise RuntimeError('sem disco')
+
+    for funcao_tarefa, erro in ((falha, 'Falha interna ao executar a tarefa: sem disco'), (lambda progresso: {'erro': 'Planilha inválida'}, 'Planilha inválida')):
+        tarefa_id = modulo_app.criar_tarefa('teste', funcao_tarefa)
+        funcao, args = executor.enviadas.pop()
+        funcao(*args)
+        status = _status_tarefa(cliente, tarefa_id)
+        assert (status['status'], status['erro']) == ('Falhou', erro) and 'resultado' not in status
+    assert modulo_app._tarefas_do_processo == set()
+    assert cliente.get('/tarefas/inexistente').status_code == 404
+
+
+def test_comparacao_assincrona_devolve_o_resultado_pela_tarefa(banco):
+    cliente = modulo_app.app.test_client()
+    nomes = _enviar_var(cliente, banco, 1)
+    assert modulo_app.ativar_planilha_var(1)[0]
+    resposta = _comparar(cliente, banco, nomes[gerar_dados.MODULOS[1]], assincrono='1')
+    assert resposta.status_code == 202 and resposta.get_json()['status'] == 'Na fila'
+
+    prazo = time.monotonic() + 30
+    while (status := cliente.get(resposta.get_json()['url_status']).get_json())['status'] in ('Na fila', 'Executando'):
+        assert time.monotonic() < prazo
+        time.sleep(0.05)
+    assert status['status'] == 'Concluída'
+    assert status['resultado']['total'] == 10 and cliente.get(f"/analises/{status['resultado']['analise_id']}").status_code == 200
+
+
+def test_tarefa_sem_sinal_ou_com_processo_morto_e_dada_como_perdida(banco):
+    cliente = modulo_app.app.test_client()
+    conn = modulo_app.get_db_connection()
+    agora = datetime.now()
+    processo_encerrado = subprocess.Popen([sys.executable, '-c', 'pass'])
+    processo_encerrado.wait()
+    sem_sinal = agora - timedelta(seconds=modulo_app.TAREFAS_SEM_SINAL_SEGUNDOS + 1)
+    with conn:
+        conn.executemany('INSERT INTO tarefas (id, tipo, status, etapa, criado_em, atualizado_em, pid) VALUES (?, "teste", ?, "Processando", ?, ?, ?)', [
+            ('viva', 'Executando', agora, agora, os.getpid()),
+            ('sem_sinal', 'Executando', sem_sinal, sem_sinal, os.getpid()),
+            ('na_fila_sem_sinal', 'Na fila', sem_sinal, sem_sinal, os.getpid()),
+            ('processo_morto', 'Executando', agora, agora, processo_encerrado.pid),
+            ('concluida_antiga', 'Concluída', sem_sinal, sem_sinal, processo_encerrado.pid),
+        ])
+        conn.execute("UPDATE tarefas SET resultado = '{}' WHERE id = 'concluida_antiga'")
+
+    assert _status_tarefa(cliente, 'viva')['status'] == 'Executando'
+    assert _status_tarefa(cliente, 'concluida_antiga')['status'] == 'Concluída'
+    for tarefa_id in ('sem_sinal', 'na_fila_sem_sinal', 'processo_morto'):
+        status = _status_tarefa(cliente, tarefa_id)
+        assert status['status'] == 'Falhou' and 'interrompida' in status['erro'], tarefa_id
+    # A marcação fica gravada: a próxima consulta não depende de detectar de novo.
+    assert conn.execute("SELECT status FROM tarefas WHERE id = 'sem_sinal'").fetchone()[0] == 'Falhou'
+
+
+# --- conexões e histórico da VAR ---
+def test_conexao_somente_leitura_recusa_escritas(banco):
+    leitura = modulo_app.get_db_connection(somente_leitura=True)
+    escrita = modulo_app.get_db_connection()
+    assert leitura is modulo_app.get_db_connection(somente_leitura=True) and leitura is not escrita
+    for comando in ("INSERT INTO uploads_historico (nome_arquivo_original, nome_arquivo_salvo, timestamp, status) VALUES ('a', 'a', '2025-01-01', 'Válido')",
+                    'CREATE TABLE qualquer (id INTEGER)', 'DELETE FROM uploads_historico'):
+        with pytest.raises(sqlite3.OperationalError, match='readonly'):
+            leitura.execute(comando)
+    # O INSERT recusado deixa o BEGIN implícito aberto; o teardown da requisição o desfaz.
+    modulo_app.liberar_conexoes()
+    assert not leitura.in_transaction
+
+    # Continua enxergando o que a conexão de escrita grava.
+    with escrita:
+        escrita.execute("INSERT INTO uploads_historico (nome_arquivo_original, nome_arquivo_salvo, timestamp, status) VALUES ('a', 'a', '2025-01-01', 'Válido')")
+    assert leitura.execute('SELECT COUNT(*) FROM uploads_historico').fetchone()[0] == 1
+
+
+def test_listar_historico_var_nas_bordas_das_paginas(banco):
+    conn = modulo_app.get_db_connection()
+    assert modulo_app.listar_historico_var(conn, 1, 20) == {'total': 0, 'pagina': 1, 'tamanho_pagina': 20, 'total_paginas': 0, 'itens': []}
+    # Vários uploads no mesmo segundo: a ordem entre eles não pode variar de uma página para a outra.
+    with conn:
+        conn.executemany('INSERT INTO uploads_historico (nome_arquivo_original, nome_arquivo_salvo, timestamp, status) VALUES (?, ?, ?, ?)',
+                         [(f'v{indice}.xlsx', f'v{indice}.xlsx', f'2025-01-{1 + indice // 4:02d} 10:00:00', 'Válido') for indice in range(41)])
+
+    def ids(pagina, tamanho):
+        return [item['id'] for item in modulo_app.listar_historico_var(conn, pagina, tamanho)['itens']]
+
+    esperado = [row[0] for row in conn.execute('SELECT id FROM uploads_historico ORDER BY timestamp DESC, id DESC')]
+    assert [len(ids(pagina, 20)) for pagina in (1, 2, 3, 4)] == [20, 20, 1, 0]
+    assert ids(1, 20) + ids(2, 20) + ids(3, 20) == esperado
+    assert modulo_app.listar_historico_var(conn, 3, 20)['total_paginas'] == 3
+    assert modulo_app.listar_historico_var(conn, 1, 41)['total_paginas'] == 1
+    assert modulo_app.listar_historico_var(conn, 1, 40)['total_paginas'] == 2
+    assert [ids(pagina, 4) for pagina in range(1, 12)] == [esperado[inicio:inicio + 4] for inicio in range(0, 44, 4)]
+    assert modulo_app.listar_historico_var(conn, 1, 1)['itens'][0]['timestamp_formatado'] == '11/01/2025 às 10:00'
+
+    cliente = modulo_app.app.test_client()
+    pagina = cliente.get('/historico_var', query_string={'pagina': 3, 'tamanho_pagina': 20}).get_json()
+    assert [item['id'] for item in pagina['itens']] == esperado[40:] and pagina['itens'][0]['url_ativar'].endswith(f'/ativar_var/{esperado[40]}')
+    for invalido in ({'pagina': 0}, {'tamanho_pagina': 501}, {'pagina': 'x'}):
+        assert cliente.get('/historico_var', query_string=invalido).status_code == 400
+
+
+def test_historico_de_matrizes_sod_paginado(banco):
+    conn = modulo_app.get_db_connection()
+    with conn:
+        conn.executemany('INSERT INTO matrizes_risco_historico (nome_arquivo_original, timestamp, status, total_riscos) VALUES (?, ?, ?, ?)',
+                         [(f'matriz_{indice}.xlsx', datetime(2025, 1, 1 + indice, 9, 30), 'Arquivado', indice) for indice in range(25)])
+        conn.execute("UPDATE matrizes_risco_historico SET status = 'Ativo' WHERE nome_arquivo_original = 'matriz_24.xlsx'")
+    cliente = modulo_app.app.test_client()
+
+    pagina = cliente.get('/sod_analyzer').get_data(as_text=True)
+    assert pagina.count('.xlsx</td>') == modulo_app.HISTORICO_POR_PAGINA
+    assert 'matriz_24.xlsx' in pagina and 'matriz_4.xlsx' not in pagina and 'historico-matrizes-mais' in pagina
+    assert '25/01/2025 às 09:30' in pagina
+
+    restante = cliente.get('/sod_analyzer/matriz/historico', query_string={'pagina': 2}).get_json()
+    assert (restante['total'], restante['total_paginas']) == (25, 2)
+    assert [item['nome_arquivo_original'] for item in restante['itens']] == [f'matriz_{indice}.xlsx' for indice in range(4, -1, -1)]
+    assert restante['itens'][0]['timestamp_formatado'] == '05/01/2025 às 09:30' and restante['itens'][0]['total_riscos'] == 4
+    assert all(item['url_ativar'].endswith(f"/sod_analyzer/matriz/ativar/{item['id']}") for item in restante['itens'])
+    primeira = cliente.get('/sod_analyzer/matriz/historico').get_json()['itens']
+    assert 'url_ativar' not in primeira[0] and primeira[0]['status'] == 'Ativo'
+    assert cliente.get('/sod_analyzer/matriz/historico', query_string={'pagina': 0}).status_code == 400
+
+
+# --- métricas ---
+def test_requisicao_sem_endpoint_nao_vira_requisicao_none(banco):
+    cliente = modulo_app.app.test_client()
+    assert cliente.get('/nao-existe').status_code == 404
+    assert cliente.post('/metrics').status_code == 405
+    modulo_app.descarregar_metricas()
+    metricas = cliente.get('/metrics').get_data(as_text=True)
+    assert 'validador_etapa_segundos_count{etapa="requisicao_nao_encontrado"}' in metricas
+    assert 'requisicao_None' not in metricas